@@ -0,0 +1,679 @@
+#!/usr/bin/python3
+
+########################################################
+# Benchmarks of the DuplicatesFinder (doublonsV3.py)   #
+########################################################
+
+__author__ = 'clsergent'
+__licence__ = 'EUPL1.2'
+
+import os
+import argparse
+import multiprocessing
+import resource
+import time
+import hashlib
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+
+import doublonsV3
+
+DUPLICATES_RATIO = 0.01     # default ratio of synthetic digests sent twice
+SYNTHETIC_SIZE = 1000000    # size of the synthetic files
+HASHIO_SIZE = 2147483648    # default size of the file hashed by the I/O benchmark
+HASHIO_BLOCK = 1048576      # size of the blocks written to generate the file hashed
+HASHERS_SIZE = 1073741824   # default number of bytes hashed by each function
+QUEUE_RECORDS = 1000000     # default number of records sent through the pipeline
+LEGACY_LIMIT = 100000       # the legacy handler is quadratic: bigger runs are not measured
+TREE_FILES = 10000          # default number of files of a synthetic tree
+TREE_MIN_SIZE = 1           # default min size of the files of a synthetic tree
+TREE_MAX_SIZE = 1048576     # default max size of the files of a synthetic tree (sizes are log-uniform)
+TREE_DUPLICATES = 0.2       # default ratio of files copying a previous file
+TREE_PREFIXES = 0.1         # default ratio of files sharing the size and first bytes of a previous file, but not its content
+TREE_HARDLINKS = 0.02       # default ratio of hard links to a previous file
+TREE_WIDTH = 32             # number of directories per level of a synthetic tree
+STAGES = ('crawler', 'handler', 'checker', 'pipeline')
+LATENCY = 0.002             # default delay (seconds) added to each open and read by the latency shim
+SEEK_TIME = 0.015           # default full stroke seek time (seconds) of the disk simulated by the seek shim
+SEEK_SPAN = 1073741824      # distance (bytes) of a full stroke seek of the simulated disk
+SEEK_SETTLE = 0.004         # min delay (seconds) of a seek of the simulated disk (settle and rotation)
+SEEK_AHEAD = 1048576        # max distance (bytes) ahead of the head read without seeking (same track, read ahead)
+INODE_SPACING = 4096        # distance between two inodes of the simulated disk (files without a known extent)
+IO_ORDERS = ('none',) + doublonsV3.IO_ORDERS
+
+
+class ListQueue(object):
+    """minimal queue feeding a handler from a generator and counting what it sends (single process)"""
+    def __init__(self, values=()):
+        self._values = iter(values)
+        self.count = 0
+
+    def get(self, timeout=None):
+        return next(self._values, doublonsV3.QUEUE_END)
+
+    def put(self, value):
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class RecordQueue(ListQueue):
+    """ListQueue keeping what it sends"""
+    def __init__(self, values=()):
+        ListQueue.__init__(self, values)
+        self.values = []
+
+    def put(self, value):
+        ListQueue.put(self, value)
+        self.values.append(value)
+
+
+class TimedQueue(object):
+    """queue wrapper measuring the time spent waiting for values"""
+    def __init__(self, queue):
+        self._queue = queue
+        self.wait = 0
+
+    def get(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            return self._queue.get(timeout=timeout)
+        finally:
+            self.wait += time.perf_counter() - start
+
+    def put(self, value):
+        self._queue.put(value)
+
+    def close(self):
+        self._queue.close()
+
+
+class DelayedFile(object):
+    """file wrapper adding a delay to each read (stand-in for a high latency storage)"""
+    def __init__(self, file, latency):
+        self._file = file
+        self._latency = latency
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def read(self, *args):
+        time.sleep(self._latency)
+        return self._file.read(*args)
+
+    def readinto(self, buffer):
+        time.sleep(self._latency)
+        return self._file.readinto(buffer)
+
+
+def injectLatency(latency):
+    """delay each open and read of doublonsV3 by latency seconds (in the current process and its children)"""
+    def delayedOpen(*args, **kwds):
+        time.sleep(latency)
+        return DelayedFile(open(*args, **kwds), latency)
+    doublonsV3.open = delayedOpen
+
+
+class SimulatedDisk(object):
+    """stand-in for spinning disks: opening a file moves the head of its device to the file (physical offset, or inode
+    without FIEMAP), the delay growing with the distance unless the file is just ahead, each device serving one request at a time"""
+    def __init__(self, seekTime, span=SEEK_SPAN):
+        self._seekTime = seekTime
+        self._span = span
+        self._heads = dict()    # dict of device:position of the head
+        self._locks = dict()    # dict of device:lock held while seeking
+
+    def open(self, path, *args, **kwds):
+        file = open(path, *args, **kwds)
+        stat = os.fstat(file.fileno())
+        position = doublonsV3.physicalOffset(path)
+        if position is None:
+            position, length = stat.st_ino * INODE_SPACING, INODE_SPACING
+        else:
+            length = stat.st_size
+
+        with self._locks.setdefault(stat.st_dev, threading.Lock()):
+            distance = position - self._heads.get(stat.st_dev, 0)
+            if not 0 <= distance <= SEEK_AHEAD:
+                time.sleep(SEEK_SETTLE + (self._seekTime - SEEK_SETTLE) * min(1, abs(distance) / self._span))
+            self._heads[stat.st_dev] = position + length
+        return file
+
+
+def injectSeeks(seekTime):
+    """delay each open of doublonsV3 by the seek of a simulated spinning disk (in the current process and its children)"""
+    doublonsV3.open = SimulatedDisk(seekTime).open
+
+
+class LegacyHashHandler(doublonsV3.HashHandler):
+    """HashHandler as of version 2.2 (linear list of reduced hashes, a path string per hash)"""
+    def __init__(self, inQueue, outQueue):
+        doublonsV3.HashHandler.__init__(self, inQueue, outQueue)
+        self._hashes = dict()
+        self._reduced = list()
+
+    def getHashs(self):
+        value = self._inQueue.get()
+        while value != doublonsV3.QUEUE_END:
+            hash, path = value[:2]
+            if hash[:doublonsV3.REDUCED_LENGTH] in self._reduced:
+                if self._hashes.get(hash, False):
+                    if self._hashes[hash]:
+                        self._outQueue.put((hash,self._hashes[hash]))
+                        self._hashes[hash]= True
+                    self._outQueue.put((hash,path))
+            else:
+                self._hashes[hash] = path
+                self._reduced.append(hash[:doublonsV3.REDUCED_LENGTH])
+            value = self._inQueue.get()
+        self._inQueue.close()
+        self._outQueue.close()
+
+
+HANDLERS = {'legacy': LegacyHashHandler, 'indexed': doublonsV3.HashHandler}
+
+
+def syntheticDigests(count, ratio=DUPLICATES_RATIO):
+    """yield count (digest, path, FileInfo) records of a single size, a ratio of them being duplicates of a previous digest"""
+    step = int(1 / ratio) if ratio else 0
+    for i in range(count):
+        n = i - 1 if step and i % step == 1 else i
+        yield (hashlib.md5(n.to_bytes(8, 'little')).digest(), '/data/synthetic/dir{0:05}/file{1:09}.bin'.format(i % 10000, i),
+               doublonsV3.FileInfo(SYNTHETIC_SIZE, 1, i, 0, 1))
+
+
+def measure(queue, function, *args):
+    """run function in a child process and send back (elapsed time, peak RSS in KiB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    function(*args)
+    queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss))
+
+
+def runIsolated(function, *args):
+    """return (elapsed time, RSS increase in KiB) of function executed in a fresh process"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(queue, function) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def runHandler(name, count, ratio):
+    handler = HANDLERS[name](ListQueue(syntheticDigests(count, ratio)), ListQueue())
+    handler.getHashs()
+
+
+def benchHandler(args):
+    """compare the legacy and the indexed HashHandler on synthetic digests"""
+    print('{0:>8} {1:>12} {2:>10} {3:>12} {4:>10}'.format('handler', 'digests', 'seconds', 'digests/s', 'RSS MiB'))
+    for count in args.counts:
+        for name in HANDLERS:
+            if name == 'legacy' and count > args.legacyLimit:
+                print('{0:>8} {1:>12} {2:>10}'.format(name, count, 'skipped'))
+                continue
+            elapsed, rss = runIsolated(runHandler, name, count, args.ratio)
+            print('{0:>8} {1:>12} {2:>10.2f} {3:>12.0f} {4:>10.1f}'.format(name, count, elapsed, count / elapsed, rss / 1024))
+
+
+def produceRecords(outQueue, count, batchSize):
+    """send count records (each digest twice) through a BatchQueue"""
+    writer = doublonsV3.BatchQueue(outQueue, batchSize)
+    for digest, path, info in syntheticDigests(count // 2, 0):
+        writer.put((digest, path, info))
+        writer.put((digest, path + '.copy', info))
+    writer.close()
+
+
+def benchQueue(args):
+    """measure records/s sent from a producer process to the checker queue through a HashHandler process"""
+    print('{0:>10} {1:>12} {2:>10} {3:>12}'.format('batchSize', 'records', 'seconds', 'records/s'))
+    for batchSize in args.batchSizes:
+        inQueue, outQueue = multiprocessing.Queue(), multiprocessing.Queue()
+        producer = multiprocessing.Process(target=produceRecords, args=(inQueue, args.records, batchSize))
+        handler = doublonsV3.HashHandler(inQueue, outQueue, batchSize=batchSize)
+
+        start = time.perf_counter()
+        producer.start()
+        handler.start()
+        received = sum(1 for record in doublonsV3.readQueue(outQueue) if record[0] != doublonsV3.BUCKET_END)
+        elapsed = time.perf_counter() - start
+        producer.join()
+        handler.join()
+        print('{0:>10} {1:>12} {2:>10.2f} {3:>12.0f}'.format(batchSize, received, elapsed, received / elapsed))
+
+
+def legacyHashFile(path, hashName, blockSize=65536):
+    """complete hash as of version 2.2 (a new bytes object for each block)"""
+    hasher = getattr(hashlib, hashName)()
+    bytesRead = 0
+    with open(path, 'rb', buffering= False) as file:
+        while data := file.read(blockSize):
+            hasher.update(data)
+            bytesRead += len(data)
+    return hasher.digest(), bytesRead
+
+
+def writeFile(path, size, blockSize=HASHIO_BLOCK):
+    """write size random bytes to path (unless it already exists with this size)"""
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        return
+    block = os.urandom(blockSize)
+    with open(path, 'wb') as file:
+        for offset in range(0, size, blockSize):
+            file.write(block[:size - offset])
+
+
+def dropFile(path):
+    """release path from the page cache"""
+    with open(path, 'rb') as file:
+        doublonsV3.adviseFile(file.fileno(), 'POSIX_FADV_DONTNEED')
+
+
+def benchHashIO(args):
+    """compare the legacy read loop with the buffered and mapped hashing paths"""
+    path = os.path.join(args.directory, 'doublons-hashio.bin')
+    writeFile(path, args.size)
+
+    # (name, function, arguments after path and hash function)
+    methods = [('legacy read', legacyHashFile, ())]
+    for blockSize in args.blockSizes:
+        methods.append(('readinto {0}'.format(blockSize), doublonsV3.hashFile, (blockSize, False, args.cold)))
+        methods.append(('mmap {0}'.format(blockSize), doublonsV3.hashFile, (blockSize, True, args.cold)))
+
+    print('{0:>20} {1:>10} {2:>10} {3:>10}'.format('method', 'seconds', 'GB/s', 'RSS MiB'))
+    try:
+        for name, function, arguments in methods:
+            if args.cold:
+                dropFile(path)
+            elapsed, rss = runIsolated(function, path, args.hashFunction, *arguments)
+            print('{0:>20} {1:>10.2f} {2:>10.2f} {3:>10.1f}'.format(name, elapsed, args.size / elapsed / 1e9, rss / 1024))
+    finally:
+        if not args.keep:
+            os.remove(path)
+
+
+def benchHashers(args):
+    """measure the throughput of each hash function available (in memory, single thread)"""
+    view = memoryview(os.urandom(args.blockSize))
+    names = args.names if args.names else list(doublonsV3.HASH_FUNCTIONS)
+
+    print('{0:>12} {1:>10} {2:>10}'.format('function', 'seconds', 'GB/s'))
+    for name in names:
+        hasher = doublonsV3.HASH_FUNCTIONS[name]()
+        start = time.perf_counter()
+        for i in range(args.size // args.blockSize):
+            hasher.update(view)
+        hasher.digest()
+        elapsed = time.perf_counter() - start
+        print('{0:>12} {1:>10.2f} {2:>10.2f}'.format(name, elapsed, args.size / elapsed / 1e9))
+
+
+def writeContent(path, size, seed, flip=None):
+    """write size pseudo random bytes generated from seed, the byte at offset flip being inverted"""
+    generator = random.Random(seed)
+    with open(path, 'wb') as file:
+        for offset in range(0, size, HASHIO_BLOCK):
+            block = bytearray(generator.randbytes(min(HASHIO_BLOCK, size - offset)))
+            if flip is not None and offset <= flip < offset + len(block):
+                block[flip - offset] ^= 0xff
+            file.write(block)
+
+
+def generateTree(directory, files=TREE_FILES, minSize=TREE_MIN_SIZE, maxSize=TREE_MAX_SIZE, duplicates=TREE_DUPLICATES,
+                 prefixes=TREE_PREFIXES, hardlinks=TREE_HARDLINKS, width=TREE_WIDTH, seed=0):
+    """generate a synthetic tree of files and return its description
+
+    each file is either new (log-uniform size), a copy, a variant (same size and first bytes, one byte changed after
+    doublonsV3.HASH_BYTES) or a hard link of a previous new file"""
+    generator = random.Random(seed)
+    originals = []      # [(path, size, seed)] of the new files
+    summary = {'files': 0, 'bytes': 0, 'new': 0, 'duplicates': 0, 'prefixes': 0, 'hardlinks': 0}
+
+    for index in range(files):
+        path = os.path.join(directory, 'd{0:03}'.format(index % width), 's{0:03}'.format(index // width % width), 'f{0:08}.bin'.format(index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        draw = generator.random()
+        if originals and draw < duplicates:
+            kind = 'duplicates'
+            origin, size, contentSeed = generator.choice(originals)
+            writeContent(path, size, contentSeed)
+        elif originals and draw < duplicates + prefixes:
+            kind = 'prefixes'
+            origin, size, contentSeed = generator.choice(originals)
+            writeContent(path, size, contentSeed, generator.randrange(min(doublonsV3.HASH_BYTES, size - 1), size))
+        elif originals and draw < duplicates + prefixes + hardlinks:
+            kind = 'hardlinks'
+            origin, size, contentSeed = generator.choice(originals)
+            os.link(origin, path)
+        else:
+            kind = 'new'
+            size = int(round(minSize * (maxSize / minSize) ** generator.random()))
+            contentSeed = generator.getrandbits(64)
+            writeContent(path, size, contentSeed)
+            originals.append((path, size, contentSeed))
+
+        summary[kind] += 1
+        summary['files'] += 1
+        summary['bytes'] += size
+    return summary
+
+
+def peakRSS():
+    """return the peak RSS (MiB) of the current process and its children waited for"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def report(stage, files, bytesRead, elapsed, queueWait=None):
+    """return the measures of a stage"""
+    elapsed = max(elapsed, 1e-9)
+    return {'stage': stage, 'files': files, 'bytes': bytesRead, 'seconds': round(elapsed, 3), 'files/s': round(files / elapsed, 1),
+            'MB/s': round(bytesRead / elapsed / 1e6, 2), 'peakRSS_MiB': round(peakRSS(), 1),
+            'queueWait': None if queueWait is None else round(queueWait, 3)}
+
+
+def crawlerRecords(args):
+    """return the records sent by a FilesCrawler over args.root (run in a child process)"""
+    crawler = doublonsV3.FilesCrawler(args.root, args.hashFunction, args.hashBytes, workers=args.workers, batchSize=args.batchSize,
+                                      ioThreads=args.ioThreads, ioOrder=args.ioOrder)
+    crawler.start()
+    records = list(doublonsV3.readQueue(crawler.queue, crawler.producers))
+    crawler.join()
+    return records
+
+
+def handlerRecords(records, args):
+    """return the records sent by a HashHandler fed with records"""
+    outQueue = RecordQueue()
+    doublonsV3.HashHandler(ListQueue(records), outQueue, batchSize=1).getHashs()
+    return outQueue.values[:-1]     # without QUEUE_END
+
+
+def newChecker(args):
+    return doublonsV3.CopyChecker(args.exportFile, doublonsV3.SPLIT_SYMBOL, args.hashFunction, hashBytes=args.hashBytes,
+                                  checkers=args.checkers, processPool=args.processPool, ioOrder=args.ioOrder)
+
+
+def benchStage(queue, stage, args):
+    """measure a stage (the inputs of a standalone stage are computed beforehand) and send back its report"""
+    sys.stdout = open(os.devnull, 'w')      # logs of the processes
+
+    if stage == 'crawler':
+        crawler = doublonsV3.FilesCrawler(args.root, args.hashFunction, args.hashBytes, workers=args.workers, batchSize=args.batchSize,
+                                      ioThreads=args.ioThreads, ioOrder=args.ioOrder)
+        inQueue = TimedQueue(crawler.queue)
+        start = time.perf_counter()
+        crawler.start()
+        records = [record for record in doublonsV3.readQueue(inQueue, crawler.producers) if record[0] != doublonsV3.BUCKET]
+        elapsed = time.perf_counter() - start
+        crawler.join()
+        hashBytes = args.hashBytes if args.hashBytes > 0 else float('inf')
+        result = report(stage, len(records), sum(min(info.st_size, hashBytes) for digest, path, info in records), elapsed, inQueue.wait)
+
+    elif stage == 'handler':
+        records = crawlerRecords(args)
+        start = time.perf_counter()
+        handlerRecords(records, args)
+        result = report(stage, sum(1 for record in records if record[0] != doublonsV3.BUCKET), 0, time.perf_counter() - start)
+
+    elif stage == 'checker':
+        records = handlerRecords(crawlerRecords(args), args)
+        checker = newChecker(args)
+        checker._inQueue = ListQueue(records)
+        start = time.perf_counter()
+        checker.run()
+        result = report(stage, sum(1 for record in records if len(record) == 3), sum(stats[2] for stats in checker._stats.values()),
+                        time.perf_counter() - start)
+
+    else:
+        # as doublonsV3.run without daemon
+        crawler = doublonsV3.FilesCrawler(args.root, args.hashFunction, args.hashBytes, workers=args.workers, batchSize=args.batchSize,
+                                      ioThreads=args.ioThreads, ioOrder=args.ioOrder)
+        checker = newChecker(args)
+        handler = doublonsV3.HashHandler(crawler.queue, checker.queue, producers=crawler.producers, batchSize=args.batchSize)
+        checker._inQueue = TimedQueue(checker.queue)
+        start = time.perf_counter()
+        crawler.start()
+        handler.start()
+        checker.run()
+        elapsed = time.perf_counter() - start
+        crawler.join()
+        handler.join()
+        result = report(stage, args.tree['files'], args.tree['bytes'], elapsed, checker._inQueue.wait)
+
+    queue.put(result)
+
+
+def runStage(function, *args):
+    """return the report sent back by function executed in a fresh process"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=function, args=(queue,) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def withTree(args, function):
+    """run function(args) with args.root (generated unless supplied by args.directory) and args.exportFile"""
+    directory = tempfile.mkdtemp(prefix='doublons-benchmark-')
+    args.root = args.directory if args.directory else os.path.join(directory, 'tree')
+    args.exportFile = os.path.join(directory, 'doublons-benchmark.csv')
+    try:
+        if not os.path.isdir(args.root):
+            generateTree(args.root, args.files, args.minSize, args.maxSize, args.duplicates, args.prefixes, args.hardlinks, args.width, args.seed)
+        args.tree = describeTree(args.root)
+        function(args)
+    finally:
+        if args.keep and not args.directory:
+            print('tree kept in {0}'.format(args.root), file=sys.stderr)
+        else:
+            shutil.rmtree(directory)
+
+
+def measureStages(args):
+    reports = [runStage(benchStage, stage, args) for stage in args.stages]
+    print(json.dumps({'version': doublonsV3.__version__, 'tree': args.tree,
+                      'options': {name: getattr(args, name) for name in ('hashFunction', 'hashBytes', 'workers', 'ioThreads', 'ioOrder', 'checkers', 'processPool', 'batchSize')},
+                      'stages': reports}, indent=2))
+
+
+def benchPipeline(args):
+    """measure each stage alone and the complete pipeline on a synthetic tree, print the reports as JSON"""
+    for stage in args.stages:
+        if stage not in STAGES:
+            raise ValueError("invalid stage supplied: {0}".format(stage))
+    withTree(args, measureStages)
+
+
+def benchIOThreads(queue, ioThreads, args):
+    """measure the crawler reading files through the latency shim and send back its report with a digest of the records"""
+    sys.stdout = open(os.devnull, 'w')      # logs of the processes
+    injectLatency(args.latency)
+    crawler = doublonsV3.FilesCrawler(args.root, args.hashFunction, args.hashBytes, batchSize=args.batchSize, ioThreads=ioThreads)
+    start = time.perf_counter()
+    crawler.start()
+    records = [record for record in doublonsV3.readQueue(crawler.queue) if record[0] != doublonsV3.BUCKET]
+    elapsed = time.perf_counter() - start
+    crawler.join()
+
+    result = report('crawler', len(records), sum(min(info.st_size, args.hashBytes) for digest, path, info in records), elapsed)
+    result['ioThreads'] = ioThreads
+    result['records'] = hashlib.md5(repr([(digest, path) for digest, path, info in records]).encode()).hexdigest()
+    queue.put(result)
+
+
+def measureIOThreads(args):
+    reports = [runStage(benchIOThreads, ioThreads, args) for ioThreads in args.ioThreads]
+    for result in reports:
+        result['identical'] = result['records'] == reports[0]['records']     # records sent in the same order
+    print(json.dumps({'version': doublonsV3.__version__, 'tree': args.tree, 'latency': args.latency, 'runs': reports}, indent=2))
+
+
+def benchLatency(args):
+    """measure the first hashes read through a latency shim for each number of I/O threads, print the reports as JSON"""
+    withTree(args, measureIOThreads)
+
+
+def benchIOOrder(queue, ioOrder, args):
+    """measure the crawler reading files through the seek shim and send back its report"""
+    sys.stdout = open(os.devnull, 'w')      # logs of the processes
+    injectSeeks(args.seekTime)
+    crawler = doublonsV3.FilesCrawler(args.root, args.hashFunction, args.hashBytes, batchSize=args.batchSize, ioThreads=args.ioThreads,
+                                      ioOrder=None if ioOrder == 'none' else ioOrder)
+    start = time.perf_counter()
+    crawler.start()
+    records = [record for record in doublonsV3.readQueue(crawler.queue) if record[0] != doublonsV3.BUCKET]
+    elapsed = time.perf_counter() - start
+    crawler.join()
+
+    result = report('crawler', len(records), sum(min(info.st_size, args.hashBytes) for digest, path, info in records), elapsed)
+    result['ioOrder'] = ioOrder
+    result['records'] = hashlib.md5(repr(sorted((digest, path) for digest, path, info in records)).encode()).hexdigest()
+    queue.put(result)
+
+
+def measureIOOrders(args):
+    os.sync()       # files written by the generator get their physical location
+    reports = [runStage(benchIOOrder, ioOrder, args) for ioOrder in args.ioOrders]
+    for result in reports:
+        result['identical'] = result['records'] == reports[0]['records']     # same records, whatever their order
+    print(json.dumps({'version': doublonsV3.__version__, 'tree': args.tree, 'seekTime': args.seekTime, 'runs': reports}, indent=2))
+
+
+def benchSeeks(args):
+    """measure the first hashes read through a simulated spinning disk for each order of the reads, print the reports as JSON"""
+    for ioOrder in args.ioOrders:
+        if ioOrder not in IO_ORDERS:
+            raise ValueError("invalid ioOrder supplied: {0}".format(ioOrder))
+    withTree(args, measureIOOrders)
+
+
+def describeTree(root):
+    """return the number of files and bytes of a tree (hard links counted once)"""
+    inodes = set()
+    files, totalBytes = 0, 0
+    for directory, dirs, names in os.walk(root):
+        for name in names:
+            stat = os.lstat(os.path.join(directory, name))
+            files += 1
+            if (stat.st_dev, stat.st_ino) not in inodes:
+                inodes.add((stat.st_dev, stat.st_ino))
+                totalBytes += stat.st_size
+    return {'files': files, 'bytes': totalBytes}
+
+
+def benchTree(args):
+    """generate a synthetic tree and print its description as JSON"""
+    print(json.dumps(generateTree(args.directory, args.files, args.minSize, args.maxSize, args.duplicates, args.prefixes,
+                                  args.hardlinks, args.width, args.seed), indent=2))
+
+
+def treeParser():
+    """return the parser of the synthetic tree arguments"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-n', '--files', type=int, default=TREE_FILES, help="number of files")
+    parser.add_argument('--minSize', type=int, default=TREE_MIN_SIZE, help="min size of the files")
+    parser.add_argument('--maxSize', type=int, default=TREE_MAX_SIZE, help="max size of the files (sizes are log-uniform)")
+    parser.add_argument('--duplicates', type=float, default=TREE_DUPLICATES, help="ratio of copies of a previous file")
+    parser.add_argument('--prefixes', type=float, default=TREE_PREFIXES, help="ratio of files sharing the size and first bytes of a previous file")
+    parser.add_argument('--hardlinks', type=float, default=TREE_HARDLINKS, help="ratio of hard links to a previous file")
+    parser.add_argument('--width', type=int, default=TREE_WIDTH, help="number of directories per level")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generator")
+    return parser
+
+
+def getArgs():
+    """parse script arguments"""
+    parser = argparse.ArgumentParser(description='Benchmarks of doublonsV3')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    handler = commands.add_parser('handler', help="compare HashHandler implementations on synthetic digests")
+    handler.add_argument('counts', type=int, nargs='*', default=[1000000, 10000000], help="numbers of digests")
+    handler.add_argument('-r', '--ratio', type=float, default=DUPLICATES_RATIO, help="ratio of duplicated digests")
+    handler.add_argument('-l', '--legacyLimit', type=int, default=LEGACY_LIMIT, help="max digests sent to the legacy handler")
+    handler.set_defaults(function=benchHandler)
+
+    batch = commands.add_parser('queue', help="measure the records/s through the pipeline queues")
+    batch.add_argument('batchSizes', type=int, nargs='*', default=[1, doublonsV3.BATCH_SIZE], help="batch sizes (1 -> no batch)")
+    batch.add_argument('-n', '--records', type=int, default=QUEUE_RECORDS, help="number of records")
+    batch.set_defaults(function=benchQueue)
+
+    hashio = commands.add_parser('hashio', help="compare complete hash implementations on a big file")
+    hashio.add_argument('directory', type=str, help="directory where the file is generated")
+    hashio.add_argument('-s', '--size', type=int, default=HASHIO_SIZE, help="size of the file")
+    hashio.add_argument('-k', '--blockSizes', type=int, nargs='+', default=[65536, doublonsV3.HASH_BLOCK_SIZE], help="block sizes")
+    hashio.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function")
+    hashio.add_argument('-c', '--cold', action='store_true', help="release the file from the page cache before each run (and while hashing)")
+    hashio.add_argument('--keep', action='store_true', help="keep the generated file")
+    hashio.set_defaults(function=benchHashIO)
+
+    hashers = commands.add_parser('hashers', help="measure the throughput of the hash functions available")
+    hashers.add_argument('names', type=str, nargs='*', help="hash functions (default: all)")
+    hashers.add_argument('-s', '--size', type=int, default=HASHERS_SIZE, help="number of bytes hashed by each function")
+    hashers.add_argument('-k', '--blockSize', type=int, default=doublonsV3.HASH_BLOCK_SIZE, help="size of the blocks hashed")
+    hashers.set_defaults(function=benchHashers)
+
+    tree = commands.add_parser('tree', parents=[treeParser()], help="generate a synthetic tree")
+    tree.add_argument('directory', type=str, help="directory where the tree is generated")
+    tree.set_defaults(function=benchTree)
+
+    pipeline = commands.add_parser('pipeline', parents=[treeParser()], help="measure each stage alone and the complete pipeline (JSON)")
+    pipeline.add_argument('stages', type=str, nargs='*', default=list(STAGES), help="stages measured among {0}".format(list(STAGES)))
+    pipeline.add_argument('-d', '--directory', type=str, help="directory of the tree (generated if missing, default: temporary)")
+    pipeline.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function")
+    pipeline.add_argument('-b', '--hashBytes', type=int, default=doublonsV3.HASH_BYTES, help="number of bytes of the first hash")
+    pipeline.add_argument('-w', '--workers', type=int, default=1, help="number of processes generating the first hashes")
+    pipeline.add_argument('-i', '--ioThreads', type=int, default=1, help="number of files read at once by each process generating the first hashes")
+    pipeline.add_argument('-o', '--ioOrder', type=str, choices=doublonsV3.IO_ORDERS, help="order of the reads on each device")
+    pipeline.add_argument('-c', '--checkers', type=int, default=1, help="number of workers computing complete hashes")
+    pipeline.add_argument('-P', '--processPool', action='store_true', help="use processes to compute complete hashes")
+    pipeline.add_argument('-B', '--batchSize', type=int, default=doublonsV3.BATCH_SIZE, help="batch size of the queues")
+    pipeline.add_argument('--keep', action='store_true', help="keep the temporary tree")
+    pipeline.set_defaults(function=benchPipeline)
+
+    latency = commands.add_parser('latency', parents=[treeParser()], help="measure the first hashes on a high latency storage (shim) by number of I/O threads (JSON)")
+    latency.add_argument('ioThreads', type=int, nargs='*', default=[1, 8, 32], help="numbers of I/O threads")
+    latency.add_argument('-l', '--latency', type=float, default=LATENCY, help="delay (seconds) added to each open and read")
+    latency.add_argument('-d', '--directory', type=str, help="directory of the tree (generated if missing, default: temporary)")
+    latency.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function")
+    latency.add_argument('-b', '--hashBytes', type=int, default=doublonsV3.HASH_BYTES, help="number of bytes of the first hash")
+    latency.add_argument('-B', '--batchSize', type=int, default=doublonsV3.BATCH_SIZE, help="batch size of the queues")
+    latency.add_argument('--keep', action='store_true', help="keep the temporary tree")
+    latency.set_defaults(function=benchLatency)
+
+    seeks = commands.add_parser('seeks', parents=[treeParser()], help="measure the first hashes on a simulated spinning disk (shim) by order of the reads (JSON)")
+    seeks.add_argument('ioOrders', type=str, nargs='*', default=list(IO_ORDERS), help="orders of the reads among {0}".format(list(IO_ORDERS)))
+    seeks.add_argument('-t', '--seekTime', type=float, default=SEEK_TIME, help="full stroke seek time (seconds)")
+    seeks.add_argument('-i', '--ioThreads', type=int, default=1, help="number of files read at once (by each device with an order)")
+    seeks.add_argument('-d', '--directory', type=str, help="directory of the tree (generated if missing, default: temporary)")
+    seeks.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function")
+    seeks.add_argument('-b', '--hashBytes', type=int, default=doublonsV3.HASH_BYTES, help="number of bytes of the first hash")
+    seeks.add_argument('-B', '--batchSize', type=int, default=doublonsV3.BATCH_SIZE, help="batch size of the queues")
+    seeks.add_argument('--keep', action='store_true', help="keep the temporary tree")
+    seeks.set_defaults(function=benchSeeks)
+
+    return parser.parse_args()
+
+
+def run():
+    """run the benchmarks"""
+    args = getArgs()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    run()
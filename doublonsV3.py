@@ -4,9 +4,11 @@
 # DuplicatesFinder : a simple script to find duplicates #
 #########################################################
 
-# 1. FilesCrawler = generate a hash (based on a limited number of bytes) for each file in rootDirectory
+# 1. FilesCrawler = group files by size, then generate a hash (based on a limited number of bytes) for each file sharing its size
+#    (with --workers N, the crawler only lists files and N PartialHasher processes generate the hashes)
 # 2. HashsHandler = stores hashes and detect potential duplicates
-# 3. DuplicateChecker = calculate a complete hash for each file received and export a list of duplicates
+# 3. DuplicateChecker = split the groups of candidates of each size through intermediate hashes (tail, sampled blocks),
+#    then a complete hash (or a comparison for small groups), and export each group of duplicates once verified
 
 __author__ = 'clsergent'
 __version__ = '2.2 - 14DEC2020'
@@ -14,26 +16,218 @@ __licence__ = 'EUPL1.2'
 
 import os
 import argparse
+import fnmatch
 import multiprocessing
 import hashlib
+import sqlite3
 import timeit
+import time
+import collections
+import queue
+import concurrent.futures
+import threading
+import mmap
+import heapq
+import tempfile
+import struct
+import sys
+import json
+import re
+import http.server
+import shutil
+import itertools
+from array import array
+
+try:
+    import fcntl            # reflinks (--action reflink, unix only)
+except ImportError:
+    fcntl = None
+
+try:
+    import xxhash           # optional fast non-cryptographic hashes
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3           # optional fast tree hash
+except ImportError:
+    blake3 = None
 
 QUEUE_END = '\x03\x04'      # signal transmitted to close a queue
+BUCKET = '\x03\x01'         # signal announcing the number of files of a size: (BUCKET, size, count)
+BUCKET_END = '\x03\x02'     # signal sent once every candidate of a size was sent: (BUCKET_END, size)
 HASH_BYTES = 15000          # default number of bytes to read for a partial hash (-1 = EOF)
-HASH_BLOCK_SIZE = 65536     # max length to feed the hash function in a row
-HASH_FUNCTIONS = hashlib.algorithms_guaranteed
+HASH_BLOCK_SIZE = 1048576   # max length to feed the hash function in a row (size of the read buffer)
+DROP_INTERVAL = 67108864    # number of bytes read between two page cache releases (--dropCache)
+STAGES = 'tail:65536'       # default intermediate hashes computed before the complete one
+STAGE_MIN_SIZE = 1048576    # files smaller than this are completely hashed without intermediate stages
+COMPARE_MAX = 3             # groups of up to COMPARE_MAX files are compared block by block instead of hashed
+IO_PENDING = 4              # max number of files waiting for each I/O thread of the first hashes (--ioThreads)
+IO_ORDERS = ('inode', 'physical')   # orders of the reads on each device (--ioOrder)
+SCHEDULE_WINDOW = 4096      # number of files of several sizes whose first hashes are ordered together (--ioOrder)
+FS_IOC_FIEMAP = 0xC020660B  # ioctl returning the extents of a file (linux)
+FIEMAP = struct.Struct('QQIIII')            # start, length, flags, mapped extents, extent count, reserved
+FIEMAP_EXTENT = struct.Struct('QQQ2QI3I')   # logical, physical, length, reserved, flags, reserved
+FIEMAP_UNKNOWN = 0x6        # flags of the extents without a physical location yet (unknown, delayed allocation)
+WORKER_TASK = 64            # max number of paths sent to a hashing worker in a row
+PENDING_TASKS = 4           # max number of files waiting for each full hash worker
+BATCH_SIZE = 256            # max number of records sent through a queue in a row
+BATCH_DELAY = 0.5           # max delay (seconds) before records waiting for a batch are sent
+EXPORT_FLUSH = 10           # max delay (seconds) between two flushes of the export file
+CACHE_COMMIT = 1000         # max number of changes waiting to be written to the cache
+CACHE_DELAY = 1             # max delay (seconds) before changes waiting are written to the cache
+CHECKPOINT_DELAY = 30       # min delay (seconds) between two checkpoints of the verified buckets
+METRICS_FLUSH = 0.5         # max delay (seconds) before the counters of a process are shared
+METRICS_DELAY = 5           # default delay (seconds) between two metrics reports
+HASH_FUNCTIONS = {name: getattr(hashlib, name) for name in sorted(hashlib.algorithms_guaranteed) if not name.startswith('shake_')}
 REDUCED_LENGTH = 4          # number of bytes taken from hash to build a faster dictionnary
+SPILL_READ = 1048576        # number of bytes read in a row from a sorted run spilled to disk
+RESULTS_MAGIC = b'DBLNRES1'  # first and last bytes of a binary results file
+RESULTS_HEADER = struct.Struct('<8sI')      # magic, version
+RESULTS_GROUP = struct.Struct('<QIB')       # size, number of paths, digest length (followed by the digest and the path ids)
+RESULTS_SECTIONS = ('groups', 'directoryOffsets', 'directories', 'directoryOrder', 'directoryStarts', 'directoryPaths',
+                    'parents', 'nameOffsets', 'names', 'infos', 'pathGroups')  # sections written after the groups
+RESULTS_FOOTER = struct.Struct('<3Q{0}Q8s'.format(len(RESULTS_SECTIONS)))   # groups, paths, directories, section offsets, magic
+ACTIONS = ('hardlink', 'reflink', 'delete')    # actions applied to the duplicates (--action)
+KEEP = 'oldest'             # default file kept by each group (oldest, shortest, under:PREFIX)
+ACTION_BATCH = 64           # max number of files replaced or deleted by a thread in a row
+FICLONE = 0x40049409        # ioctl sharing the extents of a file with another one (btrfs, xfs)
 SPLIT_SYMBOL = "; "         # default symbol to separate data in the csv file
 PREFIX_PATH = ''            # default prefix added to each path in the csv file (used for relative paths)
 
 
+def registerHashFunction(name, constructor):
+    """make a hash function available, constructor returning objects with the update and digest methods of hashlib"""
+    HASH_FUNCTIONS[name] = constructor
+
+
+if xxhash:
+    for name in ('xxh32', 'xxh64', 'xxh128', 'xxh3_64', 'xxh3_128'):
+        if hasattr(xxhash, name):
+            registerHashFunction(name, getattr(xxhash, name))
+
+if blake3:
+    registerHashFunction('blake3', blake3.blake3)
+
+
+# stat data of a file sent along its path (same attribute names as os.stat_result)
+FileInfo = collections.namedtuple('FileInfo', ['st_size', 'st_dev', 'st_ino', 'st_mtime_ns', 'st_nlink'])
+
+
+class Metrics(object):
+    """counters and timers (seconds) of a stage, updated locally then shared with the process reporting them"""
+    FIELDS = ('directories', 'files', 'bytesRead', 'received', 'sent', 'groups', 'getWait', 'putWait', 'errors')
+
+    def __init__(self):
+        self._shared = multiprocessing.Array('d', len(self.FIELDS))    #several processes may update a stage (workers)
+        self._local = dict.fromkeys(self.FIELDS, 0)
+        self._flushed = time.monotonic()
+
+    def add(self, field, value=1):
+        """increase a counter"""
+        self._local[field] += value
+        if time.monotonic() - self._flushed > METRICS_FLUSH:
+            self.flush()
+
+    def flush(self):
+        """share the local counters"""
+        with self._shared.get_lock():
+            for index, field in enumerate(self.FIELDS):
+                self._shared[index] += self._local[field]
+        self._local = dict.fromkeys(self.FIELDS, 0)
+        self._flushed = time.monotonic()
+
+    def values(self):
+        """return the shared counters"""
+        return {field: round(value, 6) if field.endswith('Wait') else int(value) for field, value in zip(self.FIELDS, self._shared[:])}
+
+
+class MetricsReporter(threading.Thread):
+    """thread reporting the metrics of each stage as JSON lines (metricsFile) and/or Prometheus text (http://127.0.0.1:metricsPort)"""
+    def __init__(self, stages, queues=None, metricsFile=None, metricsPort=None, delay=METRICS_DELAY):
+        threading.Thread.__init__(self, daemon=True)
+        self._stages = stages               #dict of stage:Metrics
+        self._queues = queues if queues else dict()     #dict of name:queue whose depth (number of batches) is reported
+        self._metricsFile = metricsFile     #'-' -> stderr
+        self._delay = delay
+        self._start = time.monotonic()
+        self._stopped = threading.Event()
+        self._server = None
+        if metricsPort:
+            reporter = self
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = reporter.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', metricsPort), Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def snapshot(self, final=False):
+        """return the metrics of each stage and the depth of the queues"""
+        depths = dict()
+        for name, inQueue in self._queues.items():
+            try:
+                depths[name] = inQueue.qsize()
+            except NotImplementedError:     #macOS
+                depths[name] = None
+        return {'time': time.time(), 'elapsed': round(time.monotonic() - self._start, 3), 'final': final,
+                'stages': {stage: metrics.values() for stage, metrics in self._stages.items()}, 'queues': depths}
+
+    def prometheus(self):
+        """return the metrics in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = []
+        for field in Metrics.FIELDS:
+            name = 'doublons_' + re.sub('([A-Z])', r'_\1', field).lower()
+            name += '_seconds_total' if field.endswith('Wait') else '_total'
+            lines.append('# TYPE {0} counter'.format(name))
+            for stage, values in snapshot['stages'].items():
+                lines.append('{0}{{stage="{1}"}} {2}'.format(name, stage, values[field]))
+        lines.append('# TYPE doublons_queue_depth gauge')
+        for name, depth in snapshot['queues'].items():
+            if depth is not None:
+                lines.append('doublons_queue_depth{{queue="{0}"}} {1}'.format(name, depth))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, final=False):
+        """write a JSON line"""
+        line = json.dumps(self.snapshot(final)) + '\n'
+        if self._metricsFile == '-':
+            sys.stderr.write(line)
+        elif self._metricsFile:
+            with open(self._metricsFile, 'a') as metricsFile:
+                metricsFile.write(line)
+
+    def run(self):
+        while not self._stopped.wait(self._delay):
+            self.write()
+
+    def stop(self):
+        """write the final metrics and stop the server"""
+        self._stopped.set()
+        self.write(final=True)
+        if self._server:
+            self._server.shutdown()
+        for stage, values in self.snapshot()['stages'].items():
+            print('{0}: {1}'.format(stage, ', '.join('{0} {1}'.format(field, value) for field, value in values.items() if value)))
+
+
 class Process(multiprocessing.Process):
     """standard process class"""
-    def __init__(self, *args, hashFunction='md5', **kwds):
+    def __init__(self, *args, hashFunction='md5', metrics=None, **kwds):
         multiprocessing.Process.__init__(self, *args, **kwds)
+        self.metrics = metrics if metrics else Metrics()     #shared by the PartialHasher workers of a crawler
         
-        if hasattr(hashlib, hashFunction):
-            self._hashFunction = getattr(hashlib, hashFunction)
+        if hashFunction in HASH_FUNCTIONS:
+            self._hashName = hashFunction
+            self._hashFunction = HASH_FUNCTIONS[hashFunction]
         else:
             raise ValueError("invalid hash function supplied")
 
@@ -41,110 +235,1258 @@ class Process(multiprocessing.Process):
     def hashFunction(self):
         return self._hashFunction
 
+    @property
+    def hashName(self):
+        return self._hashName
+
     def log(self, *logs, verbose=False):
         """simple log method"""
         if not verbose:
             print("{}:".format(self.name), *logs)
+
+    def logThroughput(self, stage, files, bytesRead, elapsed):
+        """log the throughput of a stage"""
+        elapsed = max(elapsed, 1e-9)
+        self.log('{0}: {1} files, {2} bytes read in {3:.2f}s ({4:.1f} MB/s, {5:.1f} files/s)'.format(
+            stage, files, bytesRead, elapsed, bytesRead / elapsed / 1e6, files / elapsed))
+
+
+def formatCopies(size, paths, splitSymbol, prefixPath='', separator=None):
+    """return a line of the export file: size followed by the paths"""
+    # add the prefix
+    line = splitSymbol.join([prefixPath + path for path in paths])
+
+    # if requested, change the separator (for cross-platform purposes (e.g. SMB)
+    if separator:
+        line = line.replace(os.path.sep, separator)
+
+    return '{0}{1}{2}\n'.format(size, splitSymbol, line)
+
+
+_buffers = threading.local()     #read buffer of each thread
+
+
+def readBuffer(blockSize):
+    """return the read buffer of the current thread"""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != blockSize:
+        buffer = _buffers.buffer = memoryview(bytearray(blockSize))
+    return buffer
+
+
+def adviseFile(fd, advice, offset=0, length=0):
+    """give an advice (name of the os constant, e.g. 'POSIX_FADV_DONTNEED') about the use of a file to the kernel (if supported)"""
+    if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def hashFile(path, hashName, blockSize=HASH_BLOCK_SIZE, useMmap=False, dropCache=False):
+    """return the complete hash of path and the number of bytes read
+
+    the file is read into a buffer reused by the thread (or mapped with useMmap), and its pages
+    are released from the page cache once hashed with dropCache"""
+    hasher = HASH_FUNCTIONS[hashName]()
+    bytesRead = 0
+    with open(path, 'rb', buffering= False) as file:
+        fd = file.fileno()
+        adviseFile(fd, 'POSIX_FADV_SEQUENTIAL')
+
+        if useMmap and (size := os.fstat(fd).st_size):
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    while bytesRead < size:
+                        hasher.update(view[bytesRead:bytesRead+blockSize])
+                        previous, bytesRead = bytesRead, min(bytesRead + blockSize, size)
+                        if dropCache and bytesRead // DROP_INTERVAL > previous // DROP_INTERVAL:     #a DROP_INTERVAL boundary was crossed
+                            adviseFile(fd, 'POSIX_FADV_DONTNEED', 0, bytesRead)
+        else:
+            buffer = readBuffer(blockSize)
+            while length := file.readinto(buffer):
+                hasher.update(buffer[:length])
+                bytesRead += length
+                if dropCache and bytesRead // DROP_INTERVAL > (bytesRead - length) // DROP_INTERVAL:    #a DROP_INTERVAL boundary was crossed
+                    adviseFile(fd, 'POSIX_FADV_DONTNEED', 0, bytesRead)
+
+        if dropCache:
+            adviseFile(fd, 'POSIX_FADV_DONTNEED')
+    return hasher.digest(), bytesRead
+
+
+def partialHash(path, hashName, hashBytes):
+    """return the hash of the first hashBytes (-1 -> EOF) of path and the number of bytes read"""
+    hasher = HASH_FUNCTIONS[hashName]()
+    with open(path, 'rb') as file:
+        data = file.read(hashBytes)
+    hasher.update(data)
+    return hasher.digest(), len(data)
+
+
+def hashRanges(path, ranges, hashName):
+    """return the hash of the (offset, length) ranges of path and the number of bytes read"""
+    hasher = HASH_FUNCTIONS[hashName]()
+    bytesRead = 0
+    with open(path, 'rb', buffering= False) as file:
+        for offset, length in ranges:
+            file.seek(offset)
+            data = file.read(length)
+            hasher.update(data)
+            bytesRead += len(data)
+    return hasher.digest(), bytesRead
+
+
+def compareFiles(paths, blockSize=HASH_BLOCK_SIZE, hashName=None):
+    """compare files block by block in lockstep until they diverge, hashing the blocks shared by a group with hashName
+
+    return the groups of identical files [(complete hash (b'' without hashName), indexes of paths)], the number of bytes
+    read and the indexes of the files which couldn't be read (excluded from the comparison)"""
+    files, failed = dict(), []      #dict of index:file
+    try:
+        for index, path in enumerate(paths):
+            try:
+                files[index] = open(path, 'rb', buffering= False)
+            except OSError:
+                failed.append(index)
+
+        groups, identical = [(HASH_FUNCTIONS[hashName]() if hashName else None, list(files))], []
+        bytesRead = 0
+        while groups:
+            nextGroups = []
+            for hasher, group in groups:
+                blocks = []     #list of (block, indexes of the files sharing it)
+                for index in group:
+                    try:
+                        data = files[index].read(blockSize)
+                    except OSError:
+                        failed.append(index)
+                        continue
+                    bytesRead += len(data)
+                    for block, indexes in blocks:
+                        if block == data:
+                            indexes.append(index)
+                            break
+                    else:
+                        blocks.append((data, [index]))
+
+                # files left alone are different from any other one, a group splitting goes on with a copy of the hash
+                blocks = [(block, indexes) for block, indexes in blocks if len(indexes) >= 2]
+                for block, indexes in blocks:
+                    blockHasher = hasher.copy() if hasher and len(blocks) > 1 else hasher
+                    if block:
+                        if blockHasher:
+                            blockHasher.update(block)
+                        nextGroups.append((blockHasher, indexes))
+                    else:
+                        identical.append((blockHasher.digest() if blockHasher else b'', indexes))
+            groups = nextGroups
+
+        return identical, bytesRead, sorted(failed)
+    finally:
+        for file in files.values():
+            file.close()
+
+
+def unchanged(path, info):
+    """return the stat of path if its device, inode, size and modification time are still the ones of info (None otherwise)"""
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) == (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns):
+        return stat
+    return None
+
+
+def replaceFile(keep, path, action, stat=None):
+    """replace path by a hard link or a reflink of keep (through a temporary file renamed over path), or delete it
+
+    a reflink gets the owner (stat of path), the permissions and the times of path"""
+    if action == 'delete':
+        os.remove(path)
+        return
+
+    temporary = os.path.join(os.path.dirname(path), '.{0}.{1}.tmp'.format(os.path.basename(path), os.getpid()))
+    try:
+        if action == 'hardlink':
+            os.link(keep, temporary)
+        else:
+            with open(keep, 'rb') as source, open(temporary, 'xb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            stat = stat if stat else os.lstat(path)
+            os.chown(temporary, stat.st_uid, stat.st_gid)   #before the permissions (chown may clear setuid bits)
+            shutil.copystat(path, temporary)
+        os.replace(temporary, path)
+    finally:
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+
+
+def physicalOffset(path):
+    """return the physical offset of the first extent of path (FIEMAP), None if unknown"""
+    if not fcntl:
+        return None
+    request = bytearray(FIEMAP.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    if not FIEMAP.unpack_from(request)[3]:      #no extent (e.g. data stored in the inode)
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP.size)
+    if extent[5] & FIEMAP_UNKNOWN:
+        return None
+    return extent[1]
+
+
+class IOScheduler(object):
+    """order reads by device, then by inode or physical offset (FIEMAP), each device being read by its own lane of threads
+
+    on spinning disks reads follow the layout instead of the order of the walk, and devices are read at once"""
+    def __init__(self, order='inode', threads=1):
+        self._order = order
+        self._threads = threads     #threads of each lane
+        self._lanes = dict()        #dict of device:ThreadPoolExecutor, started on first use
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lanes'] = dict()
+        return state
+
+    @property
+    def lanes(self):
+        """return the number of lanes started"""
+        return max(1, len(self._lanes))
+
+    def key(self, path, info):
+        """return the position of a file on its device (files without a known extent follow, by inode)"""
+        if self._order == 'physical' and (offset := physicalOffset(path)) is not None:
+            return (0, offset)
+        return (1, info.st_ino)
+
+    def sort(self, files):
+        """return files [(path, FileInfo, ...)] ordered on each device, devices being interleaved (their lanes read at once)"""
+        devices = dict()
+        for file in files:
+            if file[1].st_dev in devices:
+                devices[file[1].st_dev].append(file)
+            else:
+                devices[file[1].st_dev] = [file]
+
+        lanes = [sorted(device, key=lambda file: self.key(file[0], file[1])) for device in devices.values()]
+        return [file for files in itertools.zip_longest(*lanes) for file in files if file is not None]
+
+    def submit(self, info, function, *args):
+        """return a future of function(*args) executed by the lane of the device of info"""
+        lane = self._lanes.get(info.st_dev)
+        if lane is None:
+            lane = self._lanes[info.st_dev] = concurrent.futures.ThreadPoolExecutor(self._threads)
+        return lane.submit(function, *args)
+
+    def shutdown(self):
+        for lane in self._lanes.values():
+            lane.shutdown()
+        self._lanes = dict()
+
+
+class Stage(object):
+    """hash computed to split candidate groups: complete ('full'), last bytes ('tail:LENGTH') or sampled blocks ('sample:COUNTxLENGTH')"""
+    def __init__(self, spec):
+        self._name = spec
+        self._count, self._length = 1, 0
+        try:
+            kind, _, param = spec.partition(':')
+            if kind == 'tail':
+                self._length = int(param)
+            elif kind == 'sample':
+                count, _, length = param.partition('x')
+                self._count, self._length = int(count), int(length)
+            elif kind != 'full' or param:
+                raise ValueError
+            if self._count <= 0 or (kind != 'full' and self._length <= 0):
+                raise ValueError
+        except ValueError:
+            raise ValueError("invalid stage {0}".format(spec))
+        self._kind = kind
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def full(self):
+        return self._kind == 'full'
+
+    def ranges(self, size, hashBytes):
+        """return the (offset, length) ranges hashed for a file of size (the first hashBytes are already hashed)"""
+        if self._kind == 'tail':
+            offset = max(size - self._length, hashBytes)
+            return [(offset, size - offset)]
+
+        # blocks evenly spread between the first hashBytes and the end of file (from hashBytes if the file is shorter than the blocks)
+        span = max(size - hashBytes - self._length, 0)
+        return [(hashBytes + span * (i + 1) // (self._count + 1), self._length) for i in range(self._count)]
+
+
+def parseStages(stages):
+    """return the list of intermediate stages from a comma separated string"""
+    return [Stage(spec) for spec in stages.split(',') if spec] if stages else []
     
 
-class FilesCrawler(Process):
-    """generate a hash based on the first bytes (hashBytes) for each file in the root directory"""
-    def __init__(self, rootDirectory, hashFunction, hashBytes=-1, **kwds):
-        Process.__init__(self, hashFunction= hashFunction)
-        
-        self._rootDirectory = rootDirectory
+class BatchQueue(object):
+    """send records to a queue by lists, flushed once batchSize records are waiting or after BATCH_DELAY"""
+    def __init__(self, outQueue, batchSize=BATCH_SIZE, delay=BATCH_DELAY, metrics=None):
+        self._outQueue = outQueue
+        self._metrics = metrics         # time spent sending is added to putWait
+        self._batchSize = batchSize     # 1 -> records are sent one by one
+        self._delay = delay
+        self._batch = []
+        self._flushed = time.monotonic()
+
+    @property
+    def delay(self):
+        return self._delay
+
+    def put(self, record):
+        """add a record to the batch"""
+        if self._batchSize <= 1:
+            self.send(record)
+            return
+
+        self._batch.append(record)
+        if len(self._batch) >= self._batchSize or time.monotonic() - self._flushed > self._delay:
+            self.flush()
+
+    def flush(self):
+        """send the records waiting"""
+        if self._batch:
+            self.send(self._batch)
+            self._batch = []
+        self._flushed = time.monotonic()
+
+    def close(self):
+        """send the records waiting and close the queue"""
+        self.flush()
+        self.send(QUEUE_END)
+
+    def send(self, value):
+        if self._metrics:
+            start = time.perf_counter()
+            self._outQueue.put(value)
+            self._metrics.add('putWait', time.perf_counter() - start)
+        else:
+            self._outQueue.put(value)
+
+
+def readQueue(inQueue, producers=1, writer=None, metrics=None):
+    """yield records received (alone or by lists) until each producer closed the queue
+
+    the records waiting in writer are sent whenever inQueue is idle, the time spent waiting is added to metrics"""
+    while producers:
+        start = time.perf_counter()
+        try:
+            value = inQueue.get(timeout=writer.delay) if writer else inQueue.get()
+        except queue.Empty:
+            writer.flush()
+            continue
+        finally:
+            if metrics:
+                metrics.add('getWait', time.perf_counter() - start)
+
+        if type(value) is list:
+            yield from value
+        elif value == QUEUE_END:
+            producers -= 1
+        else:
+            yield value
+
+
+class HashCache(object):
+    """on-disk cache of hashes (sqlite), valid as long as device, inode, size and modification time are unchanged
+
+    changes are written by short transactions, so that several processes can share the cache"""
+    TABLES = ('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, '
+              'function TEXT, length INTEGER, digest BLOB, path TEXT, scan INTEGER, PRIMARY KEY (dev, ino, function, length))',
+              'CREATE TABLE IF NOT EXISTS scans (number INTEGER)')  #scan: number of the last run which used the entry
+
+    def __init__(self, path, hashName):
+        self._path = path
+        self._hashName = hashName
+        self._pid = None            #the connection is opened in the process using the cache
+        self._connection = None
+        self._pending = dict()      #dict of statement:[parameters] waiting to be written
+        self._written = time.monotonic()
+        self._scan = None           #number of the current run, read when the connection is opened
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'], state['_connection'] = None, None
+        return state
+
+    @property
+    def connection(self):
+        """return the connection of the current process"""
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self._path, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            for table in self.TABLES:
+                self._connection.execute(table)
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info(hashes)')}
+            if columns and 'scan' not in columns:   #cache written by a previous version
+                self._connection.execute('ALTER TABLE hashes ADD COLUMN scan INTEGER')
+            if columns:
+                self._scan = self._connection.execute('SELECT max(number) FROM scans').fetchone()[0] or 0
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, stat, length):
+        """return the hash of the first length bytes (-1 -> EOF) of the file described by stat, if cached"""
+        row = self.connection.execute('SELECT size, mtime, digest FROM hashes WHERE dev=? AND ino=? AND function=? AND length=?',
+                                      (stat.st_dev, stat.st_ino, self._hashName, length)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            self.hits += 1
+            self.execute('UPDATE hashes SET scan=? WHERE dev=? AND ino=? AND size=? AND mtime=?',
+                         (self._scan, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            return row[2]
+        self.misses += 1
+        return None
+
+    def set(self, stat, length, digest, path):
+        """store the hash of the first length bytes (-1 -> EOF) of the file described by stat"""
+        self.connection     #read the number of the run
+        self.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, self._hashName, length, digest, path, self._scan))
+
+    def execute(self, statement, parameters, commit=True):
+        """add a change, written with the others once CACHE_COMMIT are waiting or after CACHE_DELAY
+
+        changes added with commit=False are written along with the next one"""
+        if statement in self._pending:
+            self._pending[statement].append(parameters)
+        else:
+            self._pending[statement] = [parameters]
+
+        if commit and (sum(len(rows) for rows in self._pending.values()) >= CACHE_COMMIT or time.monotonic() - self._written > CACHE_DELAY):
+            self.commit()
+
+    def commit(self):
+        """write the changes waiting"""
+        if self._pending:
+            with self.connection:
+                for statement, rows in self._pending.items():
+                    self.connection.executemany(statement, rows)
+            self._pending = dict()
+        self._written = time.monotonic()
+
+    def newScan(self, resume=False):
+        """start a run, whose entries are kept by prune (resume -> continue the last run), return its number"""
+        self.connection
+        if not resume or not self._scan:
+            self._scan += 1
+            with self.connection:
+                self.connection.execute('DELETE FROM scans')
+                self.connection.execute('INSERT INTO scans VALUES (?)', (self._scan,))
+        return self._scan
+
+    def prune(self, rootDirectories):
+        """remove the entries of files under rootDirectories which the current run didn't use (files deleted, modified
+        or no longer candidates), return the number of entries removed
+
+        the files are not stat'ed again: an entry used by the run was checked by get or written by set"""
+        self.commit()
+        removed = 0
+        with self.connection:
+            for rootDirectory in rootDirectories:
+                prefix = os.path.join(rootDirectory, '')
+                removed += self.connection.execute('DELETE FROM hashes WHERE (scan IS NULL OR scan<?) AND '
+                                                   '(path=? OR substr(path, 1, ?)=?)',
+                                                   (self._scan, rootDirectory, len(prefix), prefix)).rowcount
+        return removed
+
+class Checkpoint(HashCache):
+    """on-disk state of a scan (sqlite): directories listed, sizes verified and length of the export file
+
+    hashes are cached as by HashCache"""
+    TABLES = HashCache.TABLES + (
+        'CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS entries (directory TEXT, path TEXT, depth INTEGER, '
+        'size INTEGER, dev INTEGER, ino INTEGER, mtime INTEGER, nlink INTEGER)',     #size is NULL for subdirectories
+        'CREATE INDEX IF NOT EXISTS entriesDirectory ON entries (directory)',
+        'CREATE TABLE IF NOT EXISTS buckets (size INTEGER PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS export (length INTEGER)')
+
+    @staticmethod
+    def remove(path):
+        """remove a checkpoint"""
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def listing(self, directory):
+        """return the files [(path, FileInfo)] and subdirectories [(path, depth)] of a directory listed, or None"""
+        if not self.connection.execute('SELECT 1 FROM directories WHERE path=?', (directory,)).fetchone():
+            return None
+
+        files, subDirectories = [], []
+        for path, depth, *info in self.connection.execute('SELECT path, depth, size, dev, ino, mtime, nlink FROM entries '
+                                                          'WHERE directory=? ORDER BY rowid', (directory,)):
+            if info[0] is None:
+                subDirectories.append((path, depth))
+            else:
+                files.append((path, FileInfo(*info)))
+        return files, subDirectories
+
+    def saveListing(self, directory, files, subDirectories):
+        """store the files and subdirectories of a directory (written at once)"""
+        self.execute('DELETE FROM entries WHERE directory=?', (directory,), commit=False)
+        for path, info in files:
+            self.execute('INSERT INTO entries VALUES (?, ?, NULL, ?, ?, ?, ?, ?)', (directory, path) + tuple(info), commit=False)
+        for path, depth in subDirectories:
+            self.execute('INSERT INTO entries VALUES (?, ?, ?, NULL, NULL, NULL, NULL, NULL)', (directory, path, depth), commit=False)
+        self.execute('INSERT OR REPLACE INTO directories VALUES (?)', (directory,))
+
+    def buckets(self):
+        """return the set of sizes verified"""
+        return {size for size, in self.connection.execute('SELECT size FROM buckets')}
+
+    def exportLength(self):
+        """return the length of the export file when the last sizes were verified"""
+        row = self.connection.execute('SELECT length FROM export').fetchone()
+        return row[0] if row else 0
+
+    def saveBuckets(self, sizes, exportLength):
+        """store sizes verified and the length of the export file containing their duplicates"""
+        self.commit()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO buckets VALUES (?)', [(size,) for size in sizes])
+            self.connection.execute('DELETE FROM export')
+            self.connection.execute('INSERT INTO export VALUES (?)', (exportLength,))
+
+
+class PartialHasher(Process):
+    """generate a hash based on the first bytes (hashBytes) for each path received"""
+    def __init__(self, hashFunction, hashBytes=-1, taskQueue=None, outQueue=None, cache=None, batchSize=BATCH_SIZE, metrics=None,
+                 ioThreads=1, ioOrder=None, **kwds):
+        Process.__init__(self, hashFunction= hashFunction, metrics= metrics)
+
         self._hashBytes = hashBytes # hash is processed only on the first bytes (-1 -> EOF)
-        self._outQueue = multiprocessing.Queue() # queue to export hashs/paths
+        self._hashedFiles = 0
+        self._bytesRead = 0
+        self._taskQueue = taskQueue # queue of lists of (path, FileInfo) to hash
+        self._cachePath = cache     # path of the hash cache
+        self._cache = HashCache(cache, self.hashName) if cache else None
+        self._outQueue = outQueue if outQueue else multiprocessing.Queue() # queue to export hashs/paths
+        self._batchSize = batchSize
+        self._writer = BatchQueue(self._outQueue, batchSize, metrics=self.metrics)
+        self._ioThreads = ioThreads # number of files read at once (1 -> read one after the other)
+        self._executor = None       # pool of I/O threads, started by the process
+        self._ioOrder = ioOrder     # order of the reads on each device (None -> order received)
+        self._scheduler = IOScheduler(ioOrder, ioThreads) if ioOrder else None  # one lane of ioThreads per device
+        self._pending = collections.deque()     # records and files being read, sent in order
 
     @property
     def queue(self):
         """return the queue"""
         return self._outQueue
-    
+
+    def run(self):
+        """start the process"""
+        self.log('pid is {0}'.format(self.pid), verbose=True)
+        start = time.perf_counter()
+        self.startIO()
+        files = self._taskQueue.get()
+        while files != QUEUE_END:
+            for path, info in files:
+                self.hashFile(path, info)
+            files = self._taskQueue.get()
+
+        self.stopIO()
+        self.logThroughput('partial hashes', self._hashedFiles, self._bytesRead, time.perf_counter() - start)
+        self.closeCache()
+        self._writer.close()
+        self.metrics.flush()
+
+    def startIO(self):
+        """start the I/O threads"""
+        if self._scheduler:
+            self._executor = self._scheduler
+        elif self._ioThreads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._ioThreads)
+
+    def stopIO(self):
+        """send the records waiting for the I/O threads, then stop them"""
+        while self._pending:
+            self.sendPending()
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def put(self, record):
+        """send a record, after the files being read"""
+        if self._pending:
+            self._pending.append(record)
+        else:
+            self._writer.put(record)
+
+    def hashFile(self, path, info):
+        """generate a hash sent to outQueue (read by an I/O thread with ioThreads, the hashes being sent in order)"""
+        digest = self._cache.get(info, self._hashBytes) if self._cache else None
+        if self._executor:
+            future = None if digest else self.submitRead(path, info)
+            self._pending.append((path, info, digest, future))
+            while len(self._pending) > self._ioThreads * IO_PENDING * (self._scheduler.lanes if self._scheduler else 1):
+                self.sendPending()
+            return
+
+        bytesRead = 0
+        if not digest:
+            try:
+                digest, bytesRead = partialHash(path, self.hashName, self._hashBytes)
+            except OSError:
+                digest = None
+        self.sendHash(path, info, digest, bytesRead)
+
+    def submitRead(self, path, info):
+        """return a future of the first hash of path (read by the lane of its device with ioOrder)"""
+        if self._scheduler:
+            return self._scheduler.submit(info, partialHash, path, self.hashName, self._hashBytes)
+        return self._executor.submit(partialHash, path, self.hashName, self._hashBytes)
+
+    def sendPending(self):
+        """send the first record waiting"""
+        value = self._pending.popleft()
+        if len(value) != 4:
+            self._writer.put(value)
+            return
+
+        path, info, digest, future = value
+        bytesRead = 0
+        if future:
+            try:
+                digest, bytesRead = future.result()
+            except OSError:
+                digest = None
+        self.sendHash(path, info, digest, bytesRead)
+
+    def sendHash(self, path, info, digest, bytesRead):
+        """send the hash of a file (None if it couldn't be read), cached unless no byte was read (cache hit)"""
+        if digest is None:
+            self.log('an error occurred while reading {0}'.format(path))
+            self.metrics.add('errors')
+            self._writer.put((None, path, info))    #the file is still counted in its bucket
+            return
+
+        self._writer.put((digest, path, info))
+        self.metrics.add('sent')
+        if bytesRead:
+            self._hashedFiles += 1
+            self._bytesRead += bytesRead
+            self.metrics.add('bytesRead', bytesRead)
+            if self._cache:
+                self._cache.set(info, self._hashBytes, digest, path)
+            self.log('{0} -> {1}'.format(path, digest.hex()), verbose=True)
+
+    def closeCache(self):
+        """commit the cache and log its efficiency"""
+        if self._cache:
+            self._cache.commit()
+            self.log('cache: {0} hits, {1} misses'.format(self._cache.hits, self._cache.misses))
+
+
+class FilesCrawler(PartialHasher):
+    """generate a hash based on the first bytes (hashBytes) for each file in the root directory"""
+    def __init__(self, rootDirectory, hashFunction, hashBytes=-1, workers=1, cache=None, batchSize=BATCH_SIZE,
+                 exclude=None, maxDepth=None, linksFile=None, splitSymbol=SPLIT_SYMBOL, prefixPath='', encoding=None, separator=None,
+                 spillRecords=0, spillDirectory=None, checkpoint=None, resume=False, ioThreads=1, hashUnique=False, ioOrder=None, **kwds):
+        PartialHasher.__init__(self, hashFunction= hashFunction, hashBytes= hashBytes, cache= cache, batchSize= batchSize, ioThreads= ioThreads,
+                               ioOrder= ioOrder)
+        
+        self._rootDirectories = [rootDirectory] if isinstance(rootDirectory, str) else list(rootDirectory)   # crawled in this order
+        self._hashUnique = hashUnique   # hash files with a unique size too (indexes merged with other scans)
+        self._workers = workers     # number of PartialHasher processes (1 -> hashes are processed by the crawler)
+        self._exclude = exclude if exclude else []  # glob patterns of names or paths to skip
+        self._maxDepth = maxDepth   # max depth of the subdirectories crawled (None -> unlimited)
+        self._linksFile = linksFile # csv file filled with hard links (None -> not exported)
+        self._spillRecords = spillRecords       # max number of files listed in memory (0 -> unlimited)
+        self._spillDirectory = spillDirectory   # directory of the files spilled to disk
+        self._checkpoint = Checkpoint(checkpoint, self.hashName) if checkpoint else None
+        self._resume = resume       # skip the directories listed and the sizes verified before an interruption
+        if self._checkpoint and cache == checkpoint:
+            self._cache = self._checkpoint      # a single connection to the checkpoint per process
+        self._splitSymbol = splitSymbol
+        self._prefixPath = prefixPath
+        self._encoding = encoding
+        self._separator = separator
+
+    @property
+    def producers(self):
+        """return the number of processes closing the queue"""
+        return self._workers + 1 if self._workers > 1 else 1
+
     def run(self):
         """start the process"""
         self.log('pid is {0}'.format(self.pid))
         self.walk()
     
     def walk(self):
-        """generate hash for files in rootDirectory"""
-        totalFiles=0
-        for root, dirs, files in os.walk(self._rootDirectory):
-            for fileName in files:
-                path = os.path.join(root,fileName)
+        """generate hash for files in the root directories sharing their size with another file"""
+        start = time.perf_counter()
+        sizes = self.listSizes() if not self._spillRecords else self.sortSizes()
 
-                # avoid non regular files
-                if not os.path.isfile(path): continue
+        if self._workers > 1:
+            self._taskQueue = multiprocessing.Queue()
+            workers = [PartialHasher(self.hashName, self._hashBytes, self._taskQueue, self._outQueue, self._cachePath, self._batchSize,
+                                     metrics=self.metrics, ioThreads=self._ioThreads, ioOrder=self._ioOrder) for i in range(self._workers)]
+            for worker in workers:
+                worker.start()
+        else:
+            self.startIO()
 
-                # avoid empty files (which can't be accurately compared)
-                try:
-                    if os.lstat(path).st_size == 0: continue
-                except:
+        # sizes verified before an interruption are already exported
+        verified = self._checkpoint.buckets() if self._resume else set()
+
+        # files with a unique size can't have a duplicate: they are never read
+        avoidedReads, avoidedBytes = 0, 0
+        window = list()     #files of several sizes ordered together with ioOrder
+        for size, files in sizes:
+            if size in verified:
+                continue
+
+            if len(files) < 2 and not self._hashUnique:
+                avoidedReads += 1
+                avoidedBytes += size if self._hashBytes < 0 else min(size, self._hashBytes)
+                continue
+
+            # announce the number of hashes of this size (a bucket is complete once they are all received)
+            self.put((BUCKET, size, len(files)))
+            if self._scheduler:
+                window.extend(files)
+                if len(window) >= SCHEDULE_WINDOW:
+                    self.hashFiles(self._scheduler.sort(window))
+                    window = list()
+            else:
+                self.hashFiles(files)
+
+        if window:
+            self.hashFiles(self._scheduler.sort(window))
+        self.log('{0} reads avoided ({1} bytes) on files with a unique size'.format(avoidedReads, avoidedBytes))
+
+        if self._workers > 1:
+            self._writer.close()
+            for worker in workers:
+                self._taskQueue.put(QUEUE_END)  #each worker closes the queue once done
+            for worker in workers:
+                worker.join()
+        else:
+            self.stopIO()
+            self.logThroughput('partial hashes', self._hashedFiles, self._bytesRead, time.perf_counter() - start)
+            self.closeCache()
+            self._writer.close()                #close the queue
+        self.metrics.flush()
+
+    def hashFiles(self, files):
+        """generate the hashes of files (sent to the workers if any)"""
+        if self._workers > 1:
+            self._writer.flush()
+            for i in range(0, len(files), WORKER_TASK):
+                self._taskQueue.put(files[i:i+WORKER_TASK])
+        else:
+            for path, info in files:
+                self.hashFile(path, info)
+
+    def listSizes(self):
+        """return (size, [(path, FileInfo)]) pairs for non empty regular files in the root directories"""
+        sizes = dict()
+        for path, info in self.scanFiles():
+            if info.st_size in sizes:
+                sizes[info.st_size].append((path, info))
+            else:
+                sizes[info.st_size] = [(path, info)]
+        return sizes.items()
+
+    def sortSizes(self):
+        """yield (size, [(path, FileInfo)]) pairs by increasing size, files being spilled to disk (bounded memory)"""
+        paths = PathTable()
+        sorter = SpillSorter(self._spillRecords, self._spillDirectory)
+        for path, info in self.scanFiles():
+            sorter.add(info.st_size.to_bytes(8, 'big'), paths.add(path, info))
+
+        size, files = None, []
+        for key, pathId in sorter:
+            if int.from_bytes(key, 'big') != size:
+                if files:
+                    yield size, files
+                size, files = int.from_bytes(key, 'big'), []
+            files.append((paths[pathId], paths.info(pathId)))
+        if files:
+            yield size, files
+
+    def scanFiles(self):
+        """yield (path, FileInfo) for files in the root directories, files sharing an inode being only listed once (the first path found)"""
+        inodes = dict()     #dict of (device, inode):(size, [paths]) for files having several links
+        for path, info in self.scanTree():
+            if info.st_nlink > 1:
+                inode = (info.st_dev, info.st_ino)
+                if inode in inodes:
+                    inodes[inode][1].append(path)
                     continue
+                inodes[inode] = (info.st_size, [path])
+            yield path, info
 
-                # generate a hash sent to outQueue
-                try:
-                    hasher = self.hashFunction()
-                    with open(path, 'rb') as file:
-                        hasher.update(file.read(self._hashBytes))
-                    self._outQueue.put((hasher.digest(), path))
-                except:
-                    self.log('an error occurred while reading {0}'.format(path))
-                else:
-                   self.log('{0} -> {1}'.format(path, hash), verbose=True)
-                                
+        self.exportLinks(inodes)
+
+    def exportLinks(self, inodes):
+        """export paths sharing an inode (they are not reported as duplicates)"""
+        links = [(size, paths) for size, paths in inodes.values() if len(paths) >= 2]
+        self.log('{0} groups of hard links ({1} paths) hashed once'.format(len(links), sum(len(paths) for size, paths in links)))
+
+        if self._linksFile:
+            # the size stated by the crawler (a file removed since then would raise)
+            with open(self._linksFile, 'w', encoding=self._encoding) as f:
+                for size, paths in links:
+                    f.write(formatCopies(size, paths, self._splitSymbol, self._prefixPath, self._separator))
+
+    def scanTree(self):
+        """yield (path, FileInfo) for non empty regular files in the root directories (top-down, like os.walk)"""
+        totalFiles = 0
+        directories = [(rootDirectory, 0) for rootDirectory in reversed(self._rootDirectories)]
+        while directories:
+            directory, depth = directories.pop()
+
+            # directories listed before an interruption are not listed again
+            listing = self._checkpoint.listing(directory) if self._resume else None
+            if listing is None:
+                listing = self.listDirectory(directory, depth)
+                if self._checkpoint:
+                    self._checkpoint.saveListing(directory, *listing)
+
+            files, subDirectories = listing
+            self.metrics.add('directories')
+            self.metrics.add('files', len(files))
+            yield from files
             totalFiles += len(files)
+
+            directories.extend(reversed(subDirectories))
             self.log('{0} controlled : {1:8}'.format('\x08'*21, totalFiles))
-            
-        self._outQueue.put(QUEUE_END)           #close the queue
+
+        if self._checkpoint:
+            self._checkpoint.commit()
+
+    def listDirectory(self, directory, depth):
+        """return the non empty regular files [(path, FileInfo)] and the subdirectories [(path, depth)] of directory"""
+        files, subDirectories = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self.isExcluded(entry):
+                        continue
+
+                    # excluded or too deep subdirectories are never listed
+                    if entry.is_dir(follow_symlinks=False):
+                        if self._maxDepth is None or depth < self._maxDepth:
+                            subDirectories.append((entry.path, depth + 1))
+                        continue
+
+                    # avoid non regular files
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+
+                    # avoid empty files (which can't be accurately compared)
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        self.metrics.add('errors')
+                        continue
+                    if stat.st_size == 0:
+                        continue
+
+                    files.append((entry.path, FileInfo(stat.st_size, stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_nlink)))
+
+        except OSError:
+            self.log('an error occurred while listing {0}'.format(directory))
+            self.metrics.add('errors')
+
+        return files, subDirectories
+
+    def isExcluded(self, entry):
+        """return True if the name or the path of entry matches an exclude pattern"""
+        for pattern in self._exclude:
+            if fnmatch.fnmatch(entry.name, pattern) or fnmatch.fnmatch(entry.path, pattern):
+                return True
+        return False
+
+
+class PathTable(object):
+    """compact storage of paths (interned directory and packed name) and their FileInfo, each path being referred to by an integer id"""
+    def __init__(self):
+        self._directoryIds = dict()         #dict of directory:id
+        self._directories = list()          #directory of each id
+        self._parents = array('L')          #directory id of each path
+        self._names = bytearray()           #packed names
+        self._offsets = array('Q', [0])     #offset of each name in names
+        self._infos = array('q')            #FileInfo fields of each path
+
+    def __len__(self):
+        return len(self._parents)
+
+    def __getitem__(self, pathId):
+        name = os.fsdecode(bytes(self._names[self._offsets[pathId]:self._offsets[pathId+1]]))
+        return os.path.join(self._directories[self._parents[pathId]], name)
+
+    def info(self, pathId):
+        """return the FileInfo of a path"""
+        width = len(FileInfo._fields)
+        return FileInfo(*self._infos[pathId*width:(pathId+1)*width])
+
+    def add(self, path, info):
+        """store path and return its id"""
+        directory, name = os.path.split(path)
+        if directory not in self._directoryIds:
+            self._directoryIds[directory] = len(self._directories)
+            self._directories.append(directory)
+
+        self._parents.append(self._directoryIds[directory])
+        self._names += os.fsencode(name)
+        self._offsets.append(len(self._names))
+        self._infos.extend(info)
+        return len(self._parents) - 1
+
+
+class ResultsWriter(object):
+    """binary results file: groups are written as soon as verified, the path table and the indexes once closed
+
+    layout (little endian): header, groups (RESULTS_GROUP + digest + uint32 path ids), RESULTS_SECTIONS (8 bytes aligned), footer"""
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(RESULTS_HEADER.pack(RESULTS_MAGIC, 1))
+        self._paths = PathTable()
+        self._groups = array('Q')           #offset of each group
+        self._pathGroups = array('I')       #group id of each path
+
+    def add(self, size, digest, files):
+        """write a group of duplicates [(path, FileInfo)], digest being empty if unknown"""
+        pathIds = array('I', [self._paths.add(path, info) for path, info in files])
+        self._pathGroups.extend([len(self._groups)] * len(pathIds))
+        self._groups.append(self._file.tell())
+        self._file.write(RESULTS_GROUP.pack(size, len(pathIds), len(digest)) + digest)
+        self.write(pathIds, align=False)
+
+    def write(self, data, align=True):
+        """write an array (little endian) or bytes, return its offset"""
+        if align:
+            self._file.write(bytes(-self._file.tell() % 8))
+        offset = self._file.tell()
+        if isinstance(data, array) and sys.byteorder == 'big':
+            data = array(data.typecode, data)
+            data.byteswap()
+        self._file.write(data)
+        return offset
+
+    def close(self):
+        """write the path table and the indexes"""
+        table = self._paths
+        self._groups.append(self._file.tell())
+        directories = [os.fsencode(directory) for directory in table._directories]
+        directoryOffsets = array('Q', [0])
+        for directory in directories:
+            directoryOffsets.append(directoryOffsets[-1] + len(directory))
+
+        # paths of each directory, directories being sorted to find the ones under a prefix
+        directoryPaths = array('I', sorted(range(len(table)), key=table._parents.__getitem__))
+        directoryStarts = array('Q', [0] * (len(directories) + 1))
+        for parent in table._parents:
+            directoryStarts[parent + 1] += 1
+        for index in range(len(directories)):
+            directoryStarts[index + 1] += directoryStarts[index]
+
+        sections = {'groups': self._groups, 'directoryOffsets': directoryOffsets, 'directories': b''.join(directories),
+                    'directoryOrder': array('I', sorted(range(len(directories)), key=directories.__getitem__)),
+                    'directoryStarts': directoryStarts, 'directoryPaths': directoryPaths,
+                    'parents': array('I', table._parents), 'nameOffsets': table._offsets, 'names': table._names,
+                    'infos': table._infos, 'pathGroups': self._pathGroups}
+        offsets = [self.write(sections[name]) for name in RESULTS_SECTIONS]
+        self._file.write(RESULTS_FOOTER.pack(len(self._groups) - 1, len(table), len(directories), *offsets, RESULTS_MAGIC))
+        self._file.close()
+
+
+class Resolver(object):
+    """apply an action (hardlink, reflink, delete) to the duplicates of each group, a file of each group being kept
+
+    files changed since they were stated are left untouched; actions are applied by a pool of threads, in batches"""
+    def __init__(self, action, keep=KEEP, dryRun=False, threads=1, log=print):
+        self._action = action
+        self._policy, _, prefix = keep.partition(':')
+        self._prefix = os.path.join(os.path.abspath(prefix), '') if prefix else None
+        self._dryRun = dryRun               #only log the actions (files are still checked)
+        self._threads = threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._batch = list()                #[(keep, FileInfo, path, FileInfo)] waiting to be submitted
+        self._futures = collections.deque()
+        self._stats = dict.fromkeys(('files', 'reclaimed', 'changed', 'skipped', 'errors'), 0)
+        self.log = log
+
+    def choose(self, files):
+        """return the index of the file kept among files [(path, FileInfo)] (None -> no file matches the policy)"""
+        indexes = range(len(files))
+        if self._policy == 'shortest':
+            return min(indexes, key=lambda index: (len(files[index][0]), files[index][0]))
+        if self._prefix:
+            indexes = [index for index in indexes if os.path.abspath(files[index][0]).startswith(self._prefix)]
+        return min(indexes, key=lambda index: (files[index][1].st_mtime_ns, files[index][0]), default=None)
+
+    def add(self, files):
+        """apply the action to a group of duplicates [(path, FileInfo)]"""
+        index = self.choose(files)
+        if index is None:
+            self._stats['skipped'] += len(files)
+            return
+
+        keep, keepInfo = files[index]
+        self._batch.extend((keep, keepInfo, path, info) for path, info in files[:index] + files[index+1:])
+        if len(self._batch) >= ACTION_BATCH:
+            self.submit()
+
+    def submit(self):
+        """submit the batch waiting, once the pool has room for it"""
+        while len(self._futures) >= self._threads * PENDING_TASKS:
+            self.collect(self._futures.popleft())
+        if self._batch:
+            self._futures.append(self._executor.submit(self.apply, self._batch))
+            self._batch = list()
+
+    def collect(self, future):
+        for name, value in future.result().items():
+            self._stats[name] += value
+
+    def apply(self, batch):
+        """apply the action to a batch of files, return the stats"""
+        stats = dict.fromkeys(self._stats, 0)
+        for keep, keepInfo, path, info in batch:
+            # guard against files changed since they were hashed
+            stat, keepStat = unchanged(path, info), unchanged(keep, keepInfo)
+            if not keepStat or not stat:
+                stats['changed'] += 1
+                continue
+            # the same file reached by two paths (bind mount, hard link) is its only copy
+            if (stat.st_dev, stat.st_ino) == (keepStat.st_dev, keepStat.st_ino):
+                stats['skipped'] += 1
+                continue
+            if self._action != 'delete' and keepInfo.st_dev != info.st_dev:
+                stats['skipped'] += 1
+                continue
+
+            # a hard link shares the owner and the permissions of the file kept
+            if self._action == 'hardlink' and (stat.st_uid, stat.st_gid, stat.st_mode) != (keepStat.st_uid, keepStat.st_gid, keepStat.st_mode):
+                stats['skipped'] += 1
+                continue
+
+            if self._dryRun:
+                self.log('dry run: {0} {1} ({2})'.format(self._action, path, keep))
+            else:
+                try:
+                    replaceFile(keep, path, self._action, stat)
+                except OSError as error:
+                    self.log('an error occurred while applying {0} to {1}: {2}'.format(self._action, path, error))
+                    stats['errors'] += 1
+                    continue
+
+            # the data of a file having other links is not released
+            stats['files'] += 1
+            if stat.st_nlink == 1:
+                stats['reclaimed'] += info.st_size
+        return stats
+
+    def close(self):
+        """wait for the batches, then log the summary"""
+        self.submit()
+        while self._futures:
+            self.collect(self._futures.popleft())
+        self._executor.shutdown()
+
+        self.log('{0}{1}: {files} files, {reclaimed} bytes reclaimed, {changed} files changed since hashed, '
+                 '{skipped} files skipped (no file to keep, same file, other device, owner or permissions), {errors} errors'.format(
+                 'dry run: ' if self._dryRun else '', self._action, **self._stats))
+
+
+class SpillSorter(object):
+    """sort (key, id) records (keys of a fixed length) keeping at most maxRecords of them in memory
+
+    the other ones are spilled to disk as sorted runs, merged once every record is added"""
+    def __init__(self, maxRecords, directory=None):
+        self._maxRecords = maxRecords
+        self._directory = directory     #directory of the temporary files (None -> system default)
+        self._records = list()
+        self._runs = list()             #temporary files of sorted runs
+        self._width = 0                 #length of a record (key + 8 bytes id)
+
+    def __len__(self):
+        return len(self._records) + sum(run.tell() for run in self._runs) // max(self._width, 1)
+
+    def add(self, key, recordId):
+        """add a record"""
+        self._records.append(key + recordId.to_bytes(8, 'big'))
+        self._width = len(self._records[-1])
+        if len(self._records) >= self._maxRecords:
+            self.spill()
+
+    def spill(self):
+        """write the records in memory as a sorted run"""
+        run = tempfile.TemporaryFile(dir=self._directory)
+        self._records.sort()
+        for record in self._records:
+            run.write(record)
+        self._records = list()
+        self._runs.append(run)
+
+    def readRun(self, run):
+        """yield the records of a run"""
+        run.seek(0)
+        size = SPILL_READ - SPILL_READ % self._width
+        while data := run.read(size):
+            for offset in range(0, len(data), self._width):
+                yield data[offset:offset+self._width]
+
+    def __iter__(self):
+        """yield the (key, id) records sorted, then release the runs"""
+        self._records.sort()
+        try:
+            for record in heapq.merge(self._records, *[self.readRun(run) for run in self._runs]):
+                yield record[:-8], int.from_bytes(record[-8:], 'big')
+        finally:
+            for run in self._runs:
+                run.close()
+            self._records, self._runs = list(), list()
+
+
+class Bucket(object):
+    """hashes received for the files of a given size"""
+    def __init__(self):
+        self.expected = None        #number of files announced by the crawler
+        self.received = 0
+        self.hashes = dict()        #dict of hash:pathId|SENT
+        self.paths = PathTable()    #paths of the hashes stored
+        self.sorter = None          #SpillSorter of (hash, pathId) replacing the index for big buckets
+
+    @property
+    def complete(self):
+        return self.received == self.expected
 
 
 class HashHandler(Process):
     """Process in charge of collecting and filtering hashs"""
-    def __init__(self, inQueue, outQueue):
+    SENT = -1                       #value meaning that duplicates were already sent
+
+    def __init__(self, inQueue, outQueue, producers=1, batchSize=BATCH_SIZE, spillRecords=0, spillDirectory=None):
         Process.__init__(self)
         
         self._inQueue = inQueue    	#queue from FilesCrawler
-        self._outQueue = outQueue  	#queue to the CopyChecker
-        self._hashes= dict()         #dict of hash:[path|True]
-        self._reduced = list()      #reduced list of hashs
+        self._outQueue = BatchQueue(outQueue, batchSize, metrics=self.metrics)  	#queue to the CopyChecker
+        self._producers = producers #number of processes feeding inQueue (each one closes it once)
+        self._buckets = dict()      #dict of size:Bucket for sizes not completely received
+        self._spillRecords = spillRecords       #max number of hashes of a bucket kept in memory (0 -> unlimited)
+        self._spillDirectory = spillDirectory   #directory of the hashes spilled to disk
     
     def run(self):
         """start the process"""
         self.log('pid is {0}'.format(self.pid))
         self.getHashs()
+
+    def bucket(self, size):
+        """return the bucket of size"""
+        if size not in self._buckets:
+            self._buckets[size] = Bucket()
+        return self._buckets[size]
     
     def getHashs(self):
         """retrieve hashes from queue"""
-        value = self._inQueue.get()
-        while value != QUEUE_END:
-            if type(value) is tuple and len(value) == 2:
-                hash, path = value
-                if hash[:REDUCED_LENGTH] in self._reduced:      #seach in reduced (fast)
-                    if self._hashes.get(hash, False):            #search full hash (slow/accurate)
-                        if self._hashes[hash]:                   #if a path is found, there is no duplicate yet
-                            self._outQueue.put((hash,self._hashes[hash]))    #send the first path
-                            self._hashes[hash]= True             #True means that there are doubles already
-                            
-                        self._outQueue.put((hash,path))         #send the double
-                        
+        for value in readQueue(self._inQueue, self._producers, self._outQueue, self.metrics):
+            if type(value) is tuple and len(value) == 3 and value[0] == BUCKET:
+                size = value[1]
+                bucket = self.bucket(size)
+                bucket.expected = value[2]
+
+                # hashes of big buckets are sorted on disk, duplicates are sent once the bucket is complete
+                if self._spillRecords and bucket.expected > self._spillRecords and not bucket.received:
+                    bucket.sorter = SpillSorter(self._spillRecords, self._spillDirectory)
+
+            elif type(value) is tuple and len(value) == 3:
+                hash, path, info = value
+                size = info.st_size
+                bucket = self.bucket(size)
+                bucket.received += 1
+                self.metrics.add('received')
+
+                if hash is None:                                    #None means the file couldn't be read
+                    pass
+                elif bucket.sorter:
+                    bucket.sorter.add(hash, bucket.paths.add(path, info))
                 else:
-                    self._hashes[hash] = path                    #add a new value
-                    self._reduced.append(hash[:REDUCED_LENGTH])
-                    
+                    pathId = bucket.hashes.get(hash)
+                    if pathId is None:
+                        bucket.hashes[hash] = bucket.paths.add(path, info)      #add a new value
+                    else:
+                        if pathId != self.SENT:                     #if a path is found, there is no duplicate yet
+                            self._outQueue.put((hash, bucket.paths[pathId], bucket.paths.info(pathId)))   #send the first path
+                            bucket.hashes[hash] = self.SENT         #there are doubles already
+                            self.metrics.add('sent')
+
+                        self._outQueue.put((hash, path, info))      #send the double
+                        self.metrics.add('sent')
+
             else:
                 self.log('data received is invalid {0}'.format(value))
-                
-            value = self._inQueue.get()
-            
+                continue
+
+            # every candidate of this size was sent
+            if bucket.complete:
+                del self._buckets[size]
+                self.closeBucket(size, bucket)
+
+        for size, bucket in self._buckets.items():
+            self.closeBucket(size, bucket)
+
         self._inQueue.close()
-        self._outQueue.put(QUEUE_END)
+        self._outQueue.close()
+        self.metrics.flush()
+
+    def closeBucket(self, size, bucket):
+        """send the duplicates of a spilled bucket, then the end of the bucket"""
+        if bucket.sorter:
+            previous, pathIds = None, []
+            for hash, pathId in bucket.sorter:
+                if hash != previous:
+                    self.sendSorted(previous, pathIds, bucket.paths)
+                    previous, pathIds = hash, []
+                pathIds.append(pathId)
+            self.sendSorted(previous, pathIds, bucket.paths)
+
+        self._outQueue.put((BUCKET_END, size))
+
+    def sendSorted(self, hash, pathIds, paths):
+        """send the paths sharing hash if there are at least two of them"""
+        if len(pathIds) >= 2:
+            for pathId in pathIds:
+                self._outQueue.put((hash, paths[pathId], paths.info(pathId)))
+            self.metrics.add('sent', len(pathIds))
 
 
 class CopyChecker(Process):
     """process in charge of verifying and exporting duplicates"""
-    def __init__(self, exportFile, splitSymbol, hashFunction, hashBytes= -1, prefixPath= '', encoding= None, separator= None, **kwds):
-        Process.__init__(self, hashFunction= hashFunction)
+    def __init__(self, exportFile, splitSymbol, hashFunction, fullHashFunction= None, hashBytes= -1, prefixPath= '', encoding= None, separator= None,
+                 checkers= 1, processPool= False, cache= None, stages= STAGES,
+                 blockSize= HASH_BLOCK_SIZE, useMmap= False, dropCache= False, compareMax= COMPARE_MAX, checkpoint= None, resume= False,
+                 resultsFile= None, action= None, keep= KEEP, dryRun= False, actionThreads= 1, ioOrder= None, **kwds):
+        Process.__init__(self, hashFunction= fullHashFunction if fullHashFunction else hashFunction)
         
         self._exportFile = exportFile
         self._splitSymbol = splitSymbol
@@ -152,8 +1494,38 @@ class CopyChecker(Process):
         self._prefixPath = prefixPath
         self._encoding = encoding
         self._separator = separator
+        self._checkers = checkers                   #number of workers computing hashes
+        self._processPool = processPool             #use processes instead of threads (hashlib releases the GIL)
+        self._cache = HashCache(cache, self.hashName) if cache else None
+        self._stages = parseStages(stages) + [Stage('full')]
+        self._blockSize = blockSize                 #size of the blocks read to compute complete hashes
+        self._useMmap = useMmap                     #map files in memory instead of reading them
+        self._dropCache = dropCache                 #release the pages of the files hashed from the page cache
+        self._compareMax = compareMax               #max size of the groups compared block by block (0 -> always hash)
+        self._checkpoint = Checkpoint(checkpoint, self.hashName) if checkpoint else None
+        self._resume = resume                       #append to the export file written before an interruption
+        if self._checkpoint and cache == checkpoint:
+            self._cache = self._checkpoint          #a single connection to the checkpoint per process
         
-        self._copies = dict()                       #copies to export
+        self._candidates = dict()                   #dict of size:{hash:[(path, FileInfo)]} for sizes not completely received
+        self._export = None                         #export file, filled as soon as copies are verified
+        self._resultsFile = resultsFile             #binary results file written along the export file (None -> not written)
+        self._results = None
+        self._action = action                       #action applied to the duplicates once verified (None -> only exported)
+        self._keep = keep                           #policy choosing the file kept by each group
+        self._dryRun = dryRun
+        self._actionThreads = actionThreads         #number of threads applying the action
+        self._resolver = None
+        self._scheduler = IOScheduler(ioOrder, checkers) if ioOrder else None     #one lane of checkers threads per device
+        self._flushed = 0
+        self._groups = 0
+        self._reclaimable = 0
+        self._stats = {stage.name: [0, 0, 0] for stage in self._stages}    #files checked, files eliminated, bytes read
+        self._stats['compare'] = [0, 0, 0]
+        self._cached = dict()                       #complete hashes of the bucket found in the cache
+        self._verified = list()                     #sizes verified since the last checkpoint
+        self._checkpointed = 0
+        self._executor = None
         self._inQueue = multiprocessing.Queue()     #queue to the CopyChecker
 
     @property
@@ -163,67 +1535,244 @@ class CopyChecker(Process):
 
     def run(self):
         self.log('pid is {0}'.format(self.pid))
-        self.checkCopies()
-        self.export()
+        mode = 'w'
+        if self._resume and os.path.exists(self._exportFile):
+            # groups exported after the last checkpoint are verified again
+            with open(self._exportFile, 'r+b') as export:
+                export.truncate(self._checkpoint.exportLength())
+            mode = 'a'
+
+        if self._resultsFile:
+            self._results = ResultsWriter(self._resultsFile)
+
+        if self._action:
+            self._resolver = Resolver(self._action, self._keep, self._dryRun, self._actionThreads, self.log)
+
+        with open(self._exportFile, mode, encoding=self._encoding) as self._export:
+            self._checkpointed = time.monotonic()
+            self.checkCopies()
+            self.saveCheckpoint()
+
+        if self._results:
+            self._results.close()
+
+        if self._resolver:
+            self._resolver.close()
+
+        # hard links are hashed once, each copy is a distinct inode
+        self.log('{0} groups of duplicates, {1} bytes reclaimable'.format(self._groups, self._reclaimable))
     
     def checkCopies(self):
         """execute an complete check over potential duplicates"""
-        value = self._inQueue.get()
-        while value != QUEUE_END:
-            if type(value) is tuple and len(value) == 2:
-                hash, path = value
-
-                # avoid invalid path (likely deleted file)
-                if not os.path.isfile(path):
-                    value = self._inQueue.get()
-                    continue
+        start = time.perf_counter()
+        self._flushed = time.monotonic()
+        if self._processPool:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self._checkers)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._checkers)
+
+        with self._executor:
+            for value in readQueue(self._inQueue, metrics=self.metrics):
+                if type(value) is tuple and len(value) == 2 and value[0] == BUCKET_END:
+                    self.checkBucket(value[1])
+
+                elif type(value) is tuple and len(value) == 3:
+                    hash, path, info = value
+                    self.metrics.add('received')
+                    if info.st_size not in self._candidates:
+                        self._candidates[info.st_size] = dict()
+                    if hash in self._candidates[info.st_size]:
+                        self._candidates[info.st_size][hash].append((path, info))
+                    else:
+                        self._candidates[info.st_size][hash] = [(path, info)]
 
-                # get full hash if file length exceed hashBytes
-                if os.lstat(path).st_size > self._hashBytes:
-                    hasher = self.hashFunction()
-                    with open(path, 'rb', buffering= False) as file:
-                        while data := file.read(HASH_BLOCK_SIZE):
-                            hasher.update(data)
-                        hash = hasher.digest()
-
-                # append the file or create a new entry
-                if self._copies.get(hash, False):
-                    self._copies[hash].append(path)
                 else:
-                    self._copies[hash] = [path]
-                    
-            else:
-                self.log('data received is invalid {0}'.format(value))
-                
-            value = self._inQueue.get()
-            
+                    self.log('data received is invalid {0}'.format(value))
+
+        if self._scheduler:
+            self._scheduler.shutdown()
         self._inQueue.close()
-    
-    def export(self):
-        """export duplicates"""
-        with open(self._exportFile, 'w', encoding=self._encoding) as f:
-            for value in self._copies.values():
-
-                # only write copies (at least two files)
-                if len(value) >= 2:
-                    # add the prefix
-                    line = self._splitSymbol.join([self._prefixPath + v for v in value])
-
-                    # if requested, change the separator (for cross-platform purposes (e.g. SMB)
-                    if self._separator:
-                        line = line.replace(os.path.sep, self._separator)
-                        
-                    f.write('{0}{1}{2}\n'.format(os.lstat(value[0]).st_size, self._splitSymbol, line))
+        self.metrics.flush()
+        self.logStages(time.perf_counter() - start)
+        if self._cache:
+            self._cache.commit()
+            self.log('cache: {0} hits, {1} misses'.format(self._cache.hits, self._cache.misses))
+
+    def checkBucket(self, size):
+        """split the groups of candidates of size through each stage and keep the copies"""
+        groups = list(self._candidates.pop(size, dict()).items())   #[(digest, [(path, FileInfo)])]
+
+        # the first hash covers the whole file: groups are already copies
+        if 0 <= size <= self._hashBytes or self._hashBytes < 0:
+            stages = []
+        elif size < STAGE_MIN_SIZE:
+            stages = self._stages[-1:]
+        else:
+            stages = self._stages
+
+        if self._cache and stages:
+            self._cached = {path: self._cache.get(info, -1) for digest, group in groups for path, info in group}
+
+        # intermediate stages are useless if every complete hash is cached
+        if self._cached and all(self._cached.get(path) for digest, group in groups for path, info in group):
+            stages = stages[-1:]
+
+        for stage in stages[:-1]:
+            groups = self.split(groups, stage)
+
+        # small groups left are compared (which stops as soon as files diverge), unless their complete hashes are cached
+        compared = list()
+        if self._compareMax and stages:
+            hashed = list()
+            for digest, group in groups:
+                if len(group) <= self._compareMax and not all(self._cached.get(path) for path, info in group):
+                    compared.append((group, self._executor.submit(compareFiles, [path for path, info in group], self._blockSize,
+                                                                  self.hashName if self._cache else None)))
+                else:
+                    hashed.append((digest, group))
+            groups = hashed
+
+        if stages:
+            groups = self.split(groups, stages[-1])
+
+        # compared files have no digest, unless it is computed for the cache
+        for group, future in compared:
+            groups.extend(self.compare(group, future))
+
+        self._cached = dict()
+        for digest, group in groups:
+            self.export(size, digest, group)
+
+        self._verified.append(size)
+        if time.monotonic() - self._checkpointed > CHECKPOINT_DELAY:
+            self.saveCheckpoint()
+
+    def compare(self, group, future):
+        """return the groups [(hash, [(path, FileInfo)])] of identical files compared by future"""
+        stats = self._stats['compare']
+        stats[0] += len(group)
+        identical, bytesRead, failed = future.result()
+        for index in failed:
+            # avoid invalid path (likely deleted file), the other files are still compared
+            self.log('an error occurred while checking {0}'.format(group[index][0]))
+            self.metrics.add('errors')
+
+        stats[1] += len(group) - sum(len(indexes) for digest, indexes in identical)
+        stats[2] += bytesRead
+        self.metrics.add('files', len(group))
+        self.metrics.add('bytesRead', bytesRead)
+        if self._cache:
+            for digest, indexes in identical:
+                for index in indexes:
+                    self._cache.set(group[index][1], -1, digest, group[index][0])
+        return [(digest, [group[index] for index in indexes]) for digest, indexes in identical]
+
+    def split(self, groups, stage):
+        """return the groups [(hash, [(path, FileInfo)])] of files sharing their stage hash (with at least two files)"""
+        files = [file for digest, group in groups for file in group]
+        stats = self._stats[stage.name]
+
+        # hashes are computed by the pool (in the order of the device with ioOrder), then read in the order of the files
+        futures = [None] * len(files)
+        order = [(path, info, index) for index, (path, info) in enumerate(files)]
+        for path, info, index in self._scheduler.sort(order) if self._scheduler else order:
+            futures[index] = self.submit(path, info, stage)
+        splitGroups = list()
+        index = 0
+        for digest, group in groups:
+            hashes = dict()
+            for path, info in group:
+                try:
+                    hash, bytesRead = futures[index].result()
+                except OSError:
+                    # avoid invalid path (likely deleted file)
+                    self.log('an error occurred while checking {0}'.format(path))
+                    self.metrics.add('errors')
+                    hash, bytesRead = None, 0
+                index += 1
+
+                stats[0] += 1
+                stats[2] += bytesRead
+                self.metrics.add('files')
+                self.metrics.add('bytesRead', bytesRead)
+                if hash is None:
+                    continue
+                if stage.full and self._cache and bytesRead:
+                    self._cache.set(info, -1, hash, path)
+
+                if hash in hashes:
+                    hashes[hash].append((path, info))
+                else:
+                    hashes[hash] = [(path, info)]
+
+            for hash, splitGroup in hashes.items():
+                if len(splitGroup) >= 2:
+                    splitGroups.append((hash, splitGroup))
+
+        stats[1] += len(files) - sum(len(group) for hash, group in splitGroups)
+        return splitGroups
 
+    def submit(self, path, info, stage):
+        """return a future of the stage hash of path (the cached complete hash if still valid)"""
+        if stage.full:
+            if digest := self._cached.get(path):
+                future = concurrent.futures.Future()
+                future.set_result((digest, 0))
+                return future
+            return self.execute(info, hashFile, path, self.hashName, self._blockSize, self._useMmap, self._dropCache)
+
+        return self.execute(info, hashRanges, path, stage.ranges(info.st_size, self._hashBytes), self.hashName)
+
+    def execute(self, info, function, *args):
+        """return a future of function(*args), executed by the lane of the device of info with ioOrder (threads only)"""
+        if self._scheduler and not self._processPool:
+            return self._scheduler.submit(info, function, *args)
+        return self._executor.submit(function, *args)
+
+    def saveCheckpoint(self):
+        """store the sizes verified along with the length of the export file"""
+        if self._checkpoint:
+            self._export.flush()
+            self._checkpoint.saveBuckets(self._verified, self._export.buffer.tell())
+            self._verified = list()
+        self._checkpointed = time.monotonic()
+
+    def logStages(self, elapsed):
+        """log the efficiency of each stage"""
+        for name, (files, eliminated, bytesRead) in self._stats.items():
+            self.logThroughput(name, files, bytesRead, elapsed)
+            self.log('{0}: {1} files eliminated'.format(name, eliminated))
     
+    def export(self, size, digest, files):
+        """export a group of duplicates [(path, FileInfo)]"""
+        self._export.write(formatCopies(size, [path for path, info in files], self._splitSymbol, self._prefixPath, self._separator))
+        if self._results:
+            self._results.add(size, digest, files)
+        if self._resolver:
+            self._resolver.add(files)
+        self._groups += 1
+        self._reclaimable += size * (len(files) - 1)
+        self.metrics.add('groups')
+
+        if time.monotonic() - self._flushed > EXPORT_FLUSH:
+            self._export.flush()
+            self._flushed = time.monotonic()
+
+
 def getArgs():
     """parse script arguments"""
     parser = argparse.ArgumentParser(description='Script looking for doubles')
     
     # arguments for FilesCrawler process
-    parser.add_argument('rootDirectory', type=str, help='root directory to search for duplicates')
-    parser.add_argument('-f', '--hashFunction', type=str, help="hash function to use from list {0}".format(HASH_FUNCTIONS))
+    parser.add_argument('rootDirectory', type=str, nargs='+', help='root directories to search for duplicates')
+    parser.add_argument('-f', '--hashFunction', type=str, help="hash function used for the first hash from list {0}".format(list(HASH_FUNCTIONS)))
+    parser.add_argument('-F', '--fullHashFunction', type=str, help="hash function used for the intermediate and complete hashes (default: hashFunction)")
     parser.add_argument('-b', '--hashBytes', type=int, help="number of bytes used for the first hash")
+    parser.add_argument('-x', '--exclude', type=str, action='append', help="glob pattern of file or directory names/paths to skip (repeatable)")
+    parser.add_argument('-m', '--maxDepth', type=int, help="max depth of the subdirectories crawled")
+    parser.add_argument('-w', '--workers', type=int, help="number of processes generating the first hashes")
+    parser.add_argument('-i', '--ioThreads', type=int, help="number of files read at once by each process generating the first hashes (high latency storage)")
+    parser.add_argument('-o', '--ioOrder', type=str, help="order the reads of each device by {0} (FIEMAP), each device being read by its own threads (spinning disks)".format(' or '.join(IO_ORDERS)))
     
     # arguments for CopyChecker
     parser.add_argument('exportFile', type=str, help="csv file filled with duplicates info")
@@ -231,20 +1780,54 @@ def getArgs():
     parser.add_argument('-e', '--encoding', type=str, help="encoding used to encode exportFile (utf8, latin1)")
     parser.add_argument('-s', '--separator', type=str, help="specific pathname separator for data in exportFile")
     parser.add_argument('-S', '--splitSymbol', type=str, help="specific symbol to separate data in exportFile")
+    parser.add_argument('-t', '--stages', type=str, help="comma separated intermediate hashes (tail:LENGTH, sample:COUNTxLENGTH) computed before the complete one (default: {0})".format(STAGES))
+    parser.add_argument('-k', '--blockSize', type=int, help="size of the blocks read to compute complete hashes (default: {0})".format(HASH_BLOCK_SIZE))
+    parser.add_argument('-M', '--useMmap', action='store_true', help="map files in memory to compute complete hashes")
+    parser.add_argument('-D', '--dropCache', action='store_true', help="release files from the page cache once hashed")
+    parser.add_argument('-N', '--compareMax', type=int, help="max number of files of a group compared block by block instead of hashed (default: {0}, 0 -> always hash)".format(COMPARE_MAX))
+    parser.add_argument('-O', '--resultsFile', type=str, help="binary results file written along exportFile (read by results.py)")
+    parser.add_argument('-a', '--action', type=str, help="action applied to the duplicates of each group, a file being kept: {0}".format(', '.join(ACTIONS)))
+    parser.add_argument('-G', '--keep', type=str, help="file kept by each group: oldest, shortest (path) or under:PREFIX (oldest file under PREFIX) (default: {0})".format(KEEP))
+    parser.add_argument('-n', '--dryRun', action='store_true', help="only log the actions which would be applied")
+    parser.add_argument('-j', '--actionThreads', type=int, help="number of threads applying the action")
+    parser.add_argument('-L', '--linksFile', type=str, help="csv file filled with hard links (not reported as duplicates)")
+    parser.add_argument('-c', '--checkers', type=int, help="number of workers computing complete hashes")
+    parser.add_argument('-P', '--processPool', action='store_true', help="use processes instead of threads to compute complete hashes")
     
     # general arguments
+    parser.add_argument('-B', '--batchSize', type=int, help="max number of records sent between processes in a row (1 -> no batch)")
+    parser.add_argument('-C', '--cache', type=str, help="sqlite file caching hashes between runs")
     # parser.add_argument('-g', '--logFile', type=str, help="log file")
+    parser.add_argument('-r', '--spillRecords', type=int, help="max number of files/hashes kept in memory by a sort, the others being spilled to disk (default: unlimited)")
+    parser.add_argument('-T', '--spillDirectory', type=str, help="directory of the files spilled to disk")
+    parser.add_argument('-K', '--checkpoint', type=str, help="sqlite file storing the progress of the scan (removed once complete)")
+    parser.add_argument('-R', '--resume', action='store_true', help="resume an interrupted scan from its checkpoint (default: exportFile.checkpoint)")
+    parser.add_argument('-J', '--metricsFile', type=str, help="file appended with the metrics of each stage as JSON lines ('-' -> stderr)")
+    parser.add_argument('-H', '--metricsPort', type=int, help="local port serving the metrics of each stage (Prometheus text format)")
+    parser.add_argument('-I', '--metricsDelay', type=float, help="delay (seconds) between two metrics reports (default: {0})".format(METRICS_DELAY))
     parser.add_argument('-d', '--daemon', action='store_true', help="run as daemon")
     
     return parser.parse_args()
 
 
+def checkRoots(rootDirectories):
+    """check that root directories exist and don't contain each other (their files would be listed twice)"""
+    for rootDirectory in rootDirectories:
+        if not os.path.isdir(rootDirectory):
+            raise ValueError("rootDirectory is invalid: {0}".format(rootDirectory))
+
+    roots = [os.path.join(os.path.realpath(rootDirectory), '') for rootDirectory in rootDirectories]
+    for index, root in enumerate(roots):
+        for other in roots[index+1:]:
+            if root.startswith(other) or other.startswith(root):
+                raise ValueError("rootDirectory contains another one: {0}".format(rootDirectories[index]))
+
+
 def checkArgs(args):
     """check args from argparse"""
     
     # rootDirectory
-    if not os.path.isdir(args.rootDirectory):
-        raise ValueError("rootDirectory is invalid")
+    checkRoots(args.rootDirectory)
     
     # exportFile
     if not os.path.isdir(os.path.dirname(args.exportFile)):
@@ -261,6 +1844,84 @@ def checkArgs(args):
     
     if not args.hashFunction:
         args.hashFunction = 'md5'
+
+    if not args.fullHashFunction:
+        args.fullHashFunction = args.hashFunction
+
+    for hashFunction in (args.hashFunction, args.fullHashFunction):
+        if hashFunction not in HASH_FUNCTIONS:
+            raise ValueError("invalid hash function supplied: {0}".format(hashFunction))
+
+    if not args.workers:
+        args.workers = 1
+    elif args.workers < 1:
+        raise ValueError("workers must be a positive number")
+
+    if not args.ioThreads:
+        args.ioThreads = 1
+    elif args.ioThreads < 1:
+        raise ValueError("ioThreads must be a positive number")
+
+    if args.ioOrder and args.ioOrder not in IO_ORDERS:
+        raise ValueError("invalid ioOrder supplied: {0}".format(args.ioOrder))
+
+    if args.stages is None:
+        args.stages = STAGES
+    parseStages(args.stages)
+
+    if args.compareMax is None:
+        args.compareMax = COMPARE_MAX
+
+    if not args.blockSize:
+        args.blockSize = HASH_BLOCK_SIZE
+    elif args.blockSize < 1:
+        raise ValueError("blockSize must be a positive number")
+
+    if not args.spillRecords:
+        args.spillRecords = 0
+    elif args.spillRecords < 2:
+        raise ValueError("spillRecords must be at least 2")
+
+    if not args.batchSize:
+        args.batchSize = BATCH_SIZE
+
+    if not args.checkers:
+        args.checkers = 1
+    elif args.checkers < 1:
+        raise ValueError("checkers must be a positive number")
+
+    if args.resume and not args.checkpoint:
+        args.checkpoint = args.exportFile + '.checkpoint'
+    if args.resume and not os.path.isfile(args.checkpoint):
+        raise ValueError("no checkpoint to resume from: {0}".format(args.checkpoint))
+    if args.resume and args.resultsFile:
+        raise ValueError("resultsFile is written at once: it can't be resumed")
+
+    if args.action and args.action not in ACTIONS:
+        raise ValueError("invalid action supplied: {0}".format(args.action))
+    if args.action == 'reflink' and not fcntl:
+        raise ValueError("reflinks are not supported on this system")
+    if args.dryRun and not args.action:
+        raise ValueError("dryRun requires an action")
+
+    if not args.keep:
+        args.keep = KEEP
+    elif args.keep not in ('oldest', 'shortest') and not (args.keep.startswith('under:') and len(args.keep) > 6):
+        raise ValueError("invalid keep policy supplied: {0}".format(args.keep))
+
+    if not args.actionThreads:
+        args.actionThreads = 1
+    elif args.actionThreads < 1:
+        raise ValueError("actionThreads must be a positive number")
+
+    if not args.metricsDelay:
+        args.metricsDelay = METRICS_DELAY
+    elif args.metricsDelay < 0:
+        raise ValueError("metricsDelay must be a positive number")
+
+    # without a cache, the hashes computed before an interruption are kept by the checkpoint
+    if args.checkpoint and not args.cache:
+        args.cache = args.checkpoint
     
     return args
 
@@ -268,19 +1929,47 @@ def checkArgs(args):
 def run():
     """run the script"""
     args = checkArgs(getArgs())
-    
+    if args.checkpoint and not args.resume:
+        Checkpoint.remove(args.checkpoint)
+
+    # entries used by this run are marked with its number, the others are pruned at the end
+    if args.cache:
+        cache = HashCache(args.cache, args.hashFunction)
+        cache.newScan(args.resume)
+
     crawler = FilesCrawler(**args.__dict__)
     checker = CopyChecker(**args.__dict__)
-    handler = HashHandler(crawler.queue, checker.queue)
+    handler = HashHandler(crawler.queue, checker.queue, producers=crawler.producers, batchSize=args.batchSize,
+                          spillRecords=args.spillRecords, spillDirectory=args.spillDirectory)
     
+    reporter = MetricsReporter({'crawler': crawler.metrics, 'handler': handler.metrics, 'checker': checker.metrics},
+                               {'hashes': crawler.queue, 'candidates': checker.queue}, args.metricsFile, args.metricsPort, args.metricsDelay)
+    if args.metricsFile:
+        reporter.start()
+
     crawler.start()
     handler.start()
     
     if args.daemon:
         checker.start()
+        checker.join()
     else:
         checker.run()
 
+    crawler.join()
+    handler.join()
+
+    # the scan is complete (in both modes, unless the checker process failed)
+    if not args.daemon or checker.exitcode == 0:
+        if args.cache and args.cache != args.checkpoint:
+            checker.log('cache: {0} entries pruned'.format(cache.prune(args.rootDirectory)))
+
+        # nothing to resume
+        if args.checkpoint:
+            Checkpoint.remove(args.checkpoint)
+
+    reporter.stop()
+
 
 if __name__ == '__main__':
     timer = timeit.Timer('run()', 'from __main__ import run')
@@ -4,42 +4,157 @@
 import os
 import argparse
 import timeit
+import itertools
 import re
+import collections
 
 SPLIT_SYMBOL = "; "
+EXPORT_BUFFER = 65536   # number of characters buffered for an export file before being written
+OPEN_EXPORTS = 256      # max number of export files open at once (the others are reopened in append mode)
+
+
+class TargetIndex(object):
+    """character trie of targets, finding every target contained in a text"""
+    def __init__(self):
+        self._root = dict()
+        self._prefix = None     # prefix shared by every target (searched before walking the trie)
+
+    def add(self, target, value):
+        """add a target and the value returned when it is found"""
+        node = self._root
+        for char in target:
+            node = node.setdefault(char, dict())
+        node.setdefault(None, []).append((target, value))
+        self._prefix = target if self._prefix is None else os.path.commonprefix([self._prefix, target])
+
+    def match(self, text):
+        """return the [(target, value)] of the targets contained in text"""
+        found = dict()
+        if self._prefix is None:
+            return []
+        
+        start = text.find(self._prefix)
+        while start != -1:
+            node = self._root
+            for char in itertools.islice(text, start, None):
+                node = node.get(char)
+                if node is None:
+                    break
+                for target, value in node.get(None, ()):
+                    found[id(value)] = (target, value)
+            start = text.find(self._prefix, start + 1)
+        return list(found.values())
+
+
+class OpenExports(object):
+    """exports whose file is open, the least recently written ones are closed beyond maxOpen"""
+    def __init__(self, maxOpen=OPEN_EXPORTS):
+        self._maxOpen = maxOpen
+        self._exports = collections.OrderedDict()
+    
+    def add(self, export):
+        """mark export as the most recently written one, closing the least recently written ones"""
+        self._exports.pop(export, None)
+        while len(self._exports) >= self._maxOpen:
+            self._exports.popitem(last=False)[0].release()
+        self._exports[export] = None
+    
+    def remove(self, export):
+        self._exports.pop(export, None)
+
+
+class BufferedExport(object):
+    """export file written by blocks of EXPORT_BUFFER characters, opened only while written"""
+    def __init__(self, path, openExports=None):
+        self._path = path
+        self._buffer = []
+        self._length = 0
+        self._file = None
+        self._mode = 'w'                    # truncated when first opened, then appended
+        self._openExports = openExports     # limit of the files open at once (None -> no limit)
+    
+    def open(self):
+        if self._openExports is not None:
+            self._openExports.add(self)
+        try:
+            self._file = open(self._path, self._mode)
+            self._mode = 'a'
+        except OSError as e:
+            print('failed to open {0} ({1})'.format(self._path, e))
+        
+    def write(self, data):
+        self._buffer.append(data)
+        self._length += len(data)
+        if self._length >= EXPORT_BUFFER:
+            self.flush()
+    
+    def flush(self):
+        if not self._file:
+            self.open()
+        elif self._openExports is not None:
+            self._openExports.add(self)
+        try:
+            self._file.write(''.join(self._buffer))
+        except (OSError, AttributeError) as e:
+            print('failed to write data to {0} ({1}): {2}'.format(self._path, e, ''.join(self._buffer)))
+        self._buffer = []
+        self._length = 0
+    
+    def release(self):
+        """close the file, reopened by the next flush"""
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    def close(self):
+        if self._buffer or self._mode == 'w':   # empty exports are created too
+            self.flush()
+        self.release()
+        if self._openExports is not None:
+            self._openExports.remove(self)
+
 
 class Extractor(object):
-    """ """
+    """extract the lines of inputFile containing each target to its export file (in a single read)"""
     def __init__(self, target, inputFile, export, splitSymbol, separator=None, **kwds):
-        self._target = target
         self._inputFile = inputFile
-        self._export = export
         self._splitSymbol = splitSymbol
+        self._targets = TargetIndex()
+        self._exports = []
+        self._openExports = OpenExports()
         
         if separator:
             self._separator = separator
         else:
             self._separator = os.path.sep
         
-    def compare(self):
-        self.exportData('', 'w')
-        with open(self._inputFile, 'r') as f:
-            line = f.readline()
-            while line != '':
-                if self._target in line:
-                    splitLine = line.replace('\n','').split(self._splitSymbol)
-                    items = splitLine[:1]    #size is first in line
-                    items += [i for i in splitLine[1:] if self._target in i]
-                    items += [i for i in splitLine[1:] if not self._target in i]
-                    self.exportData(self._splitSymbol.join(items)+'\n', mode='a')
-                line = f.readline()
+        if target is not None:
+            self.addTarget(target, export)
     
-    def exportData(self, data, mode='a'):
+    def addTarget(self, target, export):
+        """add a target extracted to the export file"""
+        export = BufferedExport(export, self._openExports)
+        self._targets.add(target, export)
+        self._exports.append(export)
+    
+    def compare(self):
+        # export files are opened when their buffer is written (empty ones when closed)
         try:
-            with open(self._export, mode) as f:
-                f.write(data)
-        except:
-            print('failed to write data to {0} ({1})'.format(self._export, data))
+            with open(self._inputFile, 'r') as f:
+                for line in f:
+                    matches = self._targets.match(line)
+                    if not matches:
+                        continue
+                    
+                    splitLine = line.replace('\n','').split(self._splitSymbol)
+                    for target, export in matches:
+                        items = splitLine[:1]    #size is first in line
+                        items += [i for i in splitLine[1:] if target in i]
+                        items += [i for i in splitLine[1:] if not target in i]
+                        export.write(self._splitSymbol.join(items)+'\n')
+        finally:
+            for export in self._exports:
+                export.close()
 
 def initParser():
     """initialization of the parser"""
@@ -67,13 +182,12 @@ def runMultiple(args):
         return
     
     root, dirs, files = next(os.walk(args.target))
+    extract = Extractor(None, args.inputFile, None, args.splitSymbol, args.separator)
     for dir in dirs:
         print("extraction from {0}".format(os.path.join(root,dir).replace(args.prefix,'')))
-        Extractor(os.path.join(root,dir).replace(args.prefix,''),
-                          args.inputFile,
-                          os.path.join(args.export,'{0}.csv'.format(dir)),
-                          args.splitSymbol,
-                          args.separator).compare()
+        extract.addTarget(os.path.join(root,dir).replace(args.prefix,''),
+                          os.path.join(args.export,'{0}.csv'.format(dir)))
+    extract.compare()
     
 def run():
     """run the script"""
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+##########################################################
+# Mergeable indexes of the DuplicatesFinder (doublonsV3) #
+##########################################################
+
+# 1. scan = each node stores the size and the first hash of every file of its root directories in an index (sqlite)
+# 2. merge = the indexes of every node are combined, files sharing their size and first hash are kept as candidates in a plan
+# 3. verify = each node computes the complete hashes of its own candidates only (no node reads the files of another one)
+# 4. report = the complete hashes of every node are combined, duplicates are exported to a csv file
+
+__author__ = 'clsergent'
+__licence__ = 'EUPL1.2'
+
+import os
+import argparse
+import concurrent.futures
+import socket
+import uuid
+
+import doublonsV3
+
+
+class Index(doublonsV3.HashCache):
+    """size, first hash and stat data of every file scanned by a node"""
+    TABLES = ('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+              'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, size INTEGER, digest BLOB, path TEXT, '
+              'dev INTEGER, ino INTEGER, mtime INTEGER, nlink INTEGER)')
+
+    def meta(self):
+        """return the description of the scan (uuid, label, hashFunction, hashBytes)"""
+        return dict(self.connection.execute('SELECT key, value FROM meta'))
+
+    def setMeta(self, **values):
+        """store the description of the scan"""
+        for item in values.items():
+            self.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', item)
+
+    def add(self, digest, path, info):
+        """store a file"""
+        self.execute('INSERT INTO files (size, digest, path, dev, ino, mtime, nlink) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (info.st_size, digest, path, info.st_dev, info.st_ino, info.st_mtime_ns, info.st_nlink))
+
+
+class Plan(doublonsV3.HashCache):
+    """candidates found across indexes, their complete hashes being computed by the node which scanned them"""
+    TABLES = ('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+              'CREATE TABLE IF NOT EXISTS indexes (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE, label TEXT, path TEXT)',
+              'CREATE TABLE IF NOT EXISTS candidates (indexId INTEGER, fileId INTEGER, size INTEGER, digest BLOB, path TEXT, '
+              'dev INTEGER, ino INTEGER, mtime INTEGER, nlink INTEGER, verify INTEGER, PRIMARY KEY (indexId, fileId))')
+
+
+class Digests(doublonsV3.HashCache):
+    """complete hashes of the candidates of an index"""
+    TABLES = ('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+              'CREATE TABLE IF NOT EXISTS digests (fileId INTEGER PRIMARY KEY, digest BLOB)')
+
+
+def scan(args):
+    """store the size and the first hash of every file of the root directories in an index"""
+    doublonsV3.Checkpoint.remove(args.index)
+    index = Index(args.index, args.hashFunction)
+    index.setMeta(uuid=str(uuid.uuid4()), label=args.label, hashFunction=args.hashFunction, hashBytes=args.hashBytes)
+
+    crawler = doublonsV3.FilesCrawler(args.rootDirectory, args.hashFunction, args.hashBytes, workers=args.workers, ioThreads=args.ioThreads,
+                                      exclude=args.exclude, maxDepth=args.maxDepth, hashUnique=True)
+    crawler.start()
+    files = 0
+    for value in doublonsV3.readQueue(crawler.queue, crawler.producers):
+        if value[0] == doublonsV3.BUCKET or value[0] is None:    #files which couldn't be read are not indexed
+            continue
+        index.add(*value)
+        files += 1
+    crawler.join()
+    index.commit()
+    print('{0}: {1} files indexed'.format(args.index, files))
+
+
+def merge(args):
+    """store in a plan the files of the indexes sharing their size and first hash"""
+    doublonsV3.Checkpoint.remove(args.plan)
+    plan = Plan(args.plan, '')
+    connection = plan.connection
+    connection.execute('CREATE TEMP TABLE keys (size INTEGER, digest BLOB, indexId INTEGER, fileId INTEGER)')
+
+    reference = None
+    for indexId, path in enumerate(args.indexes):
+        meta = Index(path, '').meta()
+        scanned = (meta['hashFunction'], meta['hashBytes'])
+        if reference is None:
+            reference = scanned
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', [('hashFunction', scanned[0]), ('hashBytes', scanned[1])])
+        elif scanned != reference:
+            raise ValueError("{0} was scanned with another hash function or hashBytes {1}".format(path, scanned))
+        connection.execute('INSERT INTO indexes VALUES (?, ?, ?, ?)', (indexId, meta['uuid'], meta['label'], path))
+        connection.commit()
+
+        connection.execute('ATTACH DATABASE ? AS source', (path,))
+        connection.execute('INSERT INTO keys SELECT size, digest, ?, id FROM source.files', (indexId,))
+        connection.commit()
+        connection.execute('DETACH DATABASE source')
+
+    # a candidate shares its size and first hash with another file of any index
+    connection.execute('CREATE INDEX temp.keysDigest ON keys (size, digest)')
+    connection.execute('CREATE TEMP TABLE candidateKeys AS SELECT indexId, fileId FROM keys WHERE (size, digest) IN '
+                       '(SELECT size, digest FROM keys GROUP BY size, digest HAVING COUNT(*) > 1)')
+    hashBytes = reference[1] if reference else -1
+    for indexId, path in enumerate(args.indexes):
+        connection.execute('ATTACH DATABASE ? AS source', (path,))
+        # the first hash of files smaller than hashBytes is already complete
+        connection.execute('INSERT INTO candidates SELECT ?, id, size, digest, path, dev, ino, mtime, nlink, ? >= 0 AND size > ? '
+                           'FROM source.files WHERE id IN (SELECT fileId FROM candidateKeys WHERE indexId = ?)',
+                           (indexId, hashBytes, hashBytes, indexId))
+        connection.commit()
+        connection.execute('DETACH DATABASE source')
+
+    for label, candidates, verified in connection.execute('SELECT label, COUNT(fileId), SUM(verify) FROM indexes '
+                                                          'LEFT JOIN candidates ON indexes.id = candidates.indexId GROUP BY indexes.id'):
+        print('{0}: {1} candidates, {2} to verify'.format(label, candidates, verified or 0))
+
+
+def verify(args):
+    """compute the complete hashes of the candidates of an index (run by the node which scanned it)"""
+    meta = Index(args.index, '').meta()
+    plan = Plan(args.plan, '')
+    row = plan.connection.execute('SELECT id FROM indexes WHERE uuid = ?', (meta['uuid'],)).fetchone()
+    if not row:
+        raise ValueError("{0} is not part of the plan".format(args.index))
+
+    doublonsV3.Checkpoint.remove(args.digests)
+    digests = Digests(args.digests, '')
+    digests.execute('INSERT INTO meta VALUES (?, ?)', ('uuid', meta['uuid']))
+    candidates = plan.connection.execute('SELECT fileId, path, size, mtime FROM candidates WHERE indexId = ? AND verify', row).fetchall()
+
+    changed, failed = 0, 0
+    with concurrent.futures.ThreadPoolExecutor(args.checkers) as executor:
+        futures = [executor.submit(verifyFile, path, size, mtime, meta['hashFunction'], args.blockSize) for fileId, path, size, mtime in candidates]
+        for (fileId, path, size, mtime), future in zip(candidates, futures):
+            try:
+                digest = future.result()
+            except OSError:
+                print('an error occurred while checking {0}'.format(path))
+                failed += 1
+                continue
+            if digest is None:
+                changed += 1
+                continue
+            digests.execute('INSERT INTO digests VALUES (?, ?)', (fileId, digest))
+    digests.commit()
+    print('{0}: {1} files verified, {2} modified since scanned, {3} errors'.format(meta['label'], len(candidates), changed, failed))
+
+
+def verifyFile(path, size, mtime, hashName, blockSize):
+    """return the complete hash of path, None if it was modified since scanned"""
+    stat = os.stat(path)
+    if stat.st_size != size or stat.st_mtime_ns != mtime:
+        return None
+    return doublonsV3.hashFile(path, hashName, blockSize)[0]
+
+
+def report(args):
+    """export the duplicates found across indexes"""
+    plan = Plan(args.plan, '')
+    connection = plan.connection
+    connection.execute('CREATE TEMP TABLE complete (indexId INTEGER, fileId INTEGER, digest BLOB, PRIMARY KEY (indexId, fileId))')
+    connection.execute('INSERT INTO complete SELECT indexId, fileId, digest FROM candidates WHERE NOT verify')
+    for path in args.digests:
+        uuidValue = Digests(path, '').connection.execute("SELECT value FROM meta WHERE key = 'uuid'").fetchone()[0]
+        connection.execute('ATTACH DATABASE ? AS source', (path,))
+        connection.execute('INSERT OR REPLACE INTO complete SELECT indexes.id, fileId, digest FROM source.digests, indexes WHERE indexes.uuid = ?',
+                           (uuidValue,))
+        connection.commit()
+        connection.execute('DETACH DATABASE source')
+
+    missing = connection.execute('SELECT COUNT(*) FROM candidates WHERE NOT EXISTS (SELECT 1 FROM complete WHERE '
+                                 'complete.indexId = candidates.indexId AND complete.fileId = candidates.fileId)').fetchone()[0]
+
+    # paths are prefixed by the label of their node if there are several ones
+    labelled = connection.execute('SELECT COUNT(DISTINCT label) FROM indexes').fetchone()[0] > 1
+    rows = connection.execute('SELECT candidates.size, complete.digest, label, candidates.path FROM candidates '
+                              'JOIN complete ON complete.indexId = candidates.indexId AND complete.fileId = candidates.fileId '
+                              'JOIN indexes ON indexes.id = candidates.indexId ORDER BY candidates.size DESC, complete.digest, indexes.id')
+
+    groups = 0
+    with open(args.exportFile, 'w', encoding=args.encoding) as export:
+        key, paths = None, []
+        for size, digest, label, path in rows:
+            if (size, digest) != key:
+                if len(paths) >= 2:
+                    export.write(doublonsV3.formatCopies(key[0], paths, args.splitSymbol, args.prefixPath, args.separator))
+                    groups += 1
+                key, paths = (size, digest), []
+            paths.append('{0}:{1}'.format(label, path) if labelled else path)
+        if len(paths) >= 2:
+            export.write(doublonsV3.formatCopies(key[0], paths, args.splitSymbol, args.prefixPath, args.separator))
+            groups += 1
+    print('{0} groups of duplicates, {1} candidates without complete hash'.format(groups, missing))
+
+
+def getArgs():
+    """parse script arguments"""
+    parser = argparse.ArgumentParser(description='Mergeable indexes of doublonsV3 (several roots or nodes)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scanner = commands.add_parser('scan', help="index the size and the first hash of every file")
+    scanner.add_argument('index', type=str, help="index file (sqlite)")
+    scanner.add_argument('rootDirectory', type=str, nargs='+', help="root directories")
+    scanner.add_argument('-l', '--label', type=str, default=socket.gethostname(), help="name of the node (default: hostname)")
+    scanner.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function used for the first hash")
+    scanner.add_argument('-b', '--hashBytes', type=int, default=doublonsV3.HASH_BYTES, help="number of bytes used for the first hash")
+    scanner.add_argument('-x', '--exclude', type=str, action='append', help="glob pattern of file or directory names/paths to skip (repeatable)")
+    scanner.add_argument('-m', '--maxDepth', type=int, help="max depth of the subdirectories crawled")
+    scanner.add_argument('-w', '--workers', type=int, default=1, help="number of processes generating the first hashes")
+    scanner.add_argument('-i', '--ioThreads', type=int, default=1, help="number of files read at once by each process")
+    scanner.set_defaults(function=scan)
+
+    merger = commands.add_parser('merge', help="find the candidates across indexes")
+    merger.add_argument('plan', type=str, help="plan file (sqlite)")
+    merger.add_argument('indexes', type=str, nargs='+', help="index files")
+    merger.set_defaults(function=merge)
+
+    verifier = commands.add_parser('verify', help="compute the complete hashes of the candidates of an index")
+    verifier.add_argument('plan', type=str, help="plan file")
+    verifier.add_argument('index', type=str, help="index file scanned by this node")
+    verifier.add_argument('digests', type=str, help="digests file (sqlite)")
+    verifier.add_argument('-c', '--checkers', type=int, default=1, help="number of workers computing complete hashes")
+    verifier.add_argument('-k', '--blockSize', type=int, default=doublonsV3.HASH_BLOCK_SIZE, help="size of the blocks read")
+    verifier.set_defaults(function=verify)
+
+    reporter = commands.add_parser('report', help="export the duplicates from the digests of every node")
+    reporter.add_argument('plan', type=str, help="plan file")
+    reporter.add_argument('exportFile', type=str, help="csv file filled with duplicates info")
+    reporter.add_argument('digests', type=str, nargs='*', help="digests files")
+    reporter.add_argument('-p', '--prefixPath', type=str, default=doublonsV3.PREFIX_PATH, help="a prefix added to the paths in exportFile")
+    reporter.add_argument('-e', '--encoding', type=str, help="encoding used to encode exportFile (utf8, latin1)")
+    reporter.add_argument('-s', '--separator', type=str, help="specific pathname separator for data in exportFile")
+    reporter.add_argument('-S', '--splitSymbol', type=str, default=doublonsV3.SPLIT_SYMBOL, help="specific symbol to separate data in exportFile")
+    reporter.set_defaults(function=report)
+
+    args = parser.parse_args()
+    if args.command == 'scan':
+        doublonsV3.checkRoots(args.rootDirectory)
+        if args.hashFunction not in doublonsV3.HASH_FUNCTIONS:
+            raise ValueError("invalid hash function supplied: {0}".format(args.hashFunction))
+    return args
+
+
+def run():
+    """run the command"""
+    args = getArgs()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+########################################################
+# Binary results of the DuplicatesFinder (doublonsV3)  #
+########################################################
+
+__author__ = 'clsergent'
+__licence__ = 'EUPL1.2'
+
+import os
+import sys
+import argparse
+import collections
+import mmap
+from array import array
+
+import doublonsV3
+
+# group of duplicates read from a results file (digest is empty if the files were compared block by block)
+Group = collections.namedtuple('Group', ['size', 'digest', 'paths'])
+
+
+class Results(object):
+    """random access to a binary results file (see doublonsV3.ResultsWriter) mapped in memory"""
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        magic, version = doublonsV3.RESULTS_HEADER.unpack_from(self._map, 0)
+        footer = doublonsV3.RESULTS_FOOTER.unpack_from(self._map, len(self._map) - doublonsV3.RESULTS_FOOTER.size)
+        if magic != doublonsV3.RESULTS_MAGIC or footer[-1] != doublonsV3.RESULTS_MAGIC:
+            raise ValueError("{0} is not a results file".format(path))
+
+        self._groupCount, self._pathCount, self._directoryCount = footer[:3]
+        offsets = dict(zip(doublonsV3.RESULTS_SECTIONS, footer[3:-1]))
+        groups, paths, directories = self._groupCount, self._pathCount, self._directoryCount
+
+        # views of the sections (copies on big endian systems)
+        self._sections = list()
+        self._groups = self.section(offsets['groups'], 'Q', groups + 1)
+        self._directoryOffsets = self.section(offsets['directoryOffsets'], 'Q', directories + 1)
+        self._directories = self.section(offsets['directories'], 'B', self._directoryOffsets[-1])
+        self._directoryOrder = self.section(offsets['directoryOrder'], 'I', directories)
+        self._directoryStarts = self.section(offsets['directoryStarts'], 'Q', directories + 1)
+        self._directoryPaths = self.section(offsets['directoryPaths'], 'I', paths)
+        self._parents = self.section(offsets['parents'], 'I', paths)
+        self._nameOffsets = self.section(offsets['nameOffsets'], 'Q', paths + 1)
+        self._names = self.section(offsets['names'], 'B', self._nameOffsets[-1])
+        self._infos = self.section(offsets['infos'], 'q', paths * len(doublonsV3.FileInfo._fields))
+        self._pathGroups = self.section(offsets['pathGroups'], 'I', paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._groupCount
+
+    def __getitem__(self, groupId):
+        return self.group(groupId)
+
+    def __iter__(self):
+        for groupId in range(self._groupCount):
+            yield self.group(groupId)
+
+    def section(self, offset, typecode, count):
+        """return the count items of typecode stored at offset"""
+        view = self._view[offset:offset + count * array(typecode).itemsize].cast(typecode)
+        if sys.byteorder == 'big' and typecode != 'B':
+            values = array(typecode, view)
+            values.byteswap()
+            view.release()
+            return values
+        self._sections.append(view)
+        return view
+
+    def close(self):
+        """release the views and unmap the file"""
+        for view in self._sections:
+            view.release()
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def pathIds(self, groupId):
+        """return the size, the digest and the path ids of a group"""
+        offset = self._groups[groupId]
+        size, count, length = doublonsV3.RESULTS_GROUP.unpack_from(self._map, offset)
+        offset += doublonsV3.RESULTS_GROUP.size
+        pathIds = array('I', self._map[offset + length:offset + length + count * 4])
+        if sys.byteorder == 'big':
+            pathIds.byteswap()
+        return size, self._map[offset:offset + length], pathIds
+
+    def group(self, groupId):
+        """return a group of duplicates"""
+        size, digest, pathIds = self.pathIds(groupId)
+        return Group(size, digest, [self.path(pathId) for pathId in pathIds])
+
+    def directory(self, directoryId):
+        """return a directory as bytes"""
+        return bytes(self._directories[self._directoryOffsets[directoryId]:self._directoryOffsets[directoryId+1]])
+
+    def path(self, pathId):
+        """return a path"""
+        name = bytes(self._names[self._nameOffsets[pathId]:self._nameOffsets[pathId+1]])
+        return os.fsdecode(os.path.join(self.directory(self._parents[pathId]), name))
+
+    def info(self, pathId):
+        """return the FileInfo of a path (as stated by the scan)"""
+        width = len(doublonsV3.FileInfo._fields)
+        return doublonsV3.FileInfo(*self._infos[pathId*width:(pathId+1)*width])
+
+    def groupsUnder(self, prefix):
+        """return the ids of the groups with a path in the directory prefix (or its subdirectories)"""
+        prefix = os.fsencode(prefix).rstrip(os.sep.encode())
+        sep = prefix + os.sep.encode()
+
+        # directories are sorted: the ones starting with prefix follow the first one greater or equal to prefix
+        low, high = 0, self._directoryCount
+        while low < high:
+            middle = (low + high) // 2
+            if self.directory(self._directoryOrder[middle]) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        groupIds = set()
+        for index in range(low, self._directoryCount):
+            directoryId = self._directoryOrder[index]
+            directory = self.directory(directoryId)
+            if not directory.startswith(prefix):
+                break
+            if directory == prefix or directory.startswith(sep):
+                for index in range(self._directoryStarts[directoryId], self._directoryStarts[directoryId+1]):
+                    groupIds.add(self._pathGroups[self._directoryPaths[index]])
+        return sorted(groupIds)
+
+    def toCsv(self, exportFile, splitSymbol=doublonsV3.SPLIT_SYMBOL, prefixPath='', separator=None, encoding=None, groupIds=None):
+        """write the groups (all of them by default) to a csv file as written by doublonsV3"""
+        groupIds = range(self._groupCount) if groupIds is None else groupIds
+        with open(exportFile, 'w', encoding=encoding) as export:
+            for groupId in groupIds:
+                size, digest, paths = self.group(groupId)
+                export.write(doublonsV3.formatCopies(size, paths, splitSymbol, prefixPath, separator))
+
+
+def getArgs():
+    """parse script arguments"""
+    parser = argparse.ArgumentParser(description='Convert a binary results file of doublonsV3 to csv')
+    parser.add_argument('resultsFile', type=str, help="binary results file (doublonsV3 --resultsFile)")
+    parser.add_argument('exportFile', type=str, help="csv file filled with duplicates info")
+    parser.add_argument('-u', '--under', type=str, help="only convert the groups with a path in this directory")
+    parser.add_argument('-p', '--prefixPath', type=str, default=doublonsV3.PREFIX_PATH, help="a prefix added to the paths in exportFile")
+    parser.add_argument('-e', '--encoding', type=str, help="encoding used to encode exportFile (utf8, latin1)")
+    parser.add_argument('-s', '--separator', type=str, help="specific pathname separator for data in exportFile")
+    parser.add_argument('-S', '--splitSymbol', type=str, default=doublonsV3.SPLIT_SYMBOL, help="specific symbol to separate data in exportFile")
+    return parser.parse_args()
+
+
+def run():
+    """convert the results file"""
+    args = getArgs()
+    with Results(args.resultsFile) as results:
+        groupIds = results.groupsUnder(args.under) if args.under else None
+        results.toCsv(args.exportFile, args.splitSymbol, args.prefixPath, args.separator, args.encoding, groupIds)
+
+
+if __name__ == '__main__':
+    run()
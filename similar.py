@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+########################################################
+# Similar files of the DuplicatesFinder (doublonsV3)   #
+########################################################
+
+# 1. the crawler lists the non empty regular files of the root directories (hard links listed once)
+# 2. workers split each file into chunks at content-defined boundaries (gear rolling hash), then hash each chunk
+# 3. (chunk, file) records are sorted with bounded memory: files sharing a chunk produce (pair of files, length) records
+# 4. pair records are sorted and summed: pairs sharing enough bytes are exported by decreasing ratio
+
+__author__ = 'clsergent'
+__licence__ = 'EUPL1.2'
+
+import os
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import tempfile
+import time
+
+import doublonsV3
+
+CHUNK_AVERAGE = 8192        # default average length of the chunks (power of 2), min and max lengths being derived from it
+SIMILAR_MIN_SIZE = 65536    # default min size of the files chunked (smaller files are only found as exact duplicates)
+SIMILAR_RATIO = 0.5         # default min ratio of bytes shared by a pair of files (to the size of the smaller one)
+SIMILAR_FILES = 64          # default max number of files sharing a chunk to pair them (common chunks like padding are skipped)
+SIMILAR_RECORDS = 1000000   # default max number of records kept in memory by each sort
+RATIO_SCALE = 1000000       # precision of the ratios sorted
+
+# random values of each byte added to the rolling hash (a chunk ends once its high bits are zero)
+GEAR = [int.from_bytes(hashlib.md5(bytes([byte])).digest()[:4], 'big') for byte in range(256)]
+
+
+def cutPoint(data, start, minSize, maxSize, mask):
+    """return the end of the chunk of data starting at start: the first position after minSize bytes where the rolling hash
+    matches mask, or maxSize bytes (the end of data if shorter)"""
+    end = min(start + maxSize, len(data))
+    gear = GEAR
+    value = 0
+    for index in range(start + minSize, end):
+        value = ((value << 1) + gear[data[index]]) & 0xFFFFFFFF
+        if not value & mask:
+            return index + 1
+    return end
+
+
+def chunkFile(path, hashName, averageSize=CHUNK_AVERAGE, blockSize=doublonsV3.HASH_BLOCK_SIZE, directory=None):
+    """write the chunks of path packed as records (hash followed by the length on 4 bytes) to a temporary file of directory,
+    return its path and the number of bytes read (the records are written by slices: memory doesn't grow with the file)"""
+    hasher = doublonsV3.HASH_FUNCTIONS[hashName]
+    minSize, maxSize = averageSize // 4, averageSize * 8
+    bits = averageSize.bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)     #high bits depend on the last 32 bytes
+
+    records = bytearray()
+    bytesRead = 0
+    output = tempfile.NamedTemporaryFile(dir=directory, prefix='doublons-chunks-', delete=False)
+    try:
+        with output, open(path, 'rb') as file:
+            data, start, eof = b'', 0, False
+            while True:
+                if len(data) - start < maxSize and not eof:
+                    block = file.read(max(blockSize, maxSize))
+                    bytesRead += len(block)
+                    eof = not block
+                    data, start = data[start:] + block, 0
+                    continue
+                if start >= len(data):
+                    break
+
+                end = cutPoint(data, start, minSize, maxSize, mask)
+                records += hasher(data[start:end]).digest() + (end - start).to_bytes(4, 'big')
+                start = end
+                if len(records) >= doublonsV3.SPILL_READ:
+                    output.write(records)
+                    records = bytearray()
+            output.write(records)
+    except BaseException:
+        os.remove(output.name)
+        raise
+    return output.name, bytesRead
+
+
+class SimilarFinder(object):
+    """find the pairs of files sharing chunks"""
+    def __init__(self, exportFile, rootDirectory, hashFunction='md5', exclude=None, maxDepth=None, workers=1, averageSize=CHUNK_AVERAGE,
+                 minSize=SIMILAR_MIN_SIZE, minRatio=SIMILAR_RATIO, maxFiles=SIMILAR_FILES, spillRecords=SIMILAR_RECORDS, spillDirectory=None,
+                 blockSize=doublonsV3.HASH_BLOCK_SIZE, splitSymbol=doublonsV3.SPLIT_SYMBOL, prefixPath='', encoding=None, separator=None, **kwds):
+        self._exportFile = exportFile
+        self._crawler = doublonsV3.FilesCrawler(rootDirectory, hashFunction, exclude=exclude, maxDepth=maxDepth)
+        self._hashName = hashFunction
+        self._workers = workers             #number of processes chunking files
+        self._averageSize = averageSize
+        self._minSize = minSize
+        self._minRatio = minRatio
+        self._maxFiles = maxFiles
+        self._spillRecords = spillRecords
+        self._spillDirectory = spillDirectory
+        self._blockSize = blockSize
+        self._splitSymbol = splitSymbol
+        self._prefixPath = prefixPath
+        self._encoding = encoding
+        self._separator = separator
+        self._paths = doublonsV3.PathTable()
+        self._stats = dict.fromkeys(('files', 'bytes', 'errors', 'chunks', 'distinct', 'savings', 'common', 'pairs'), 0)
+
+    def log(self, *logs):
+        print('similar:', *logs)
+
+    def run(self):
+        start = time.perf_counter()
+        chunks = self.chunkFiles()
+        pairs = self.pairFiles(chunks)
+        self.export(self.rankPairs(pairs))
+
+        stats = self._stats
+        self.log('{files} files chunked ({bytes} bytes, {errors} errors), {chunks} chunks, {distinct} distinct'.format(**stats))
+        self.log('{0} bytes saved by deduplicating chunks ({1:.1%}), {2} chunks shared by too many files to pair them'.format(
+                 stats['savings'], stats['savings'] / max(stats['bytes'], 1), stats['common']))
+        self.log('{0} pairs sharing at least {1:.0%} exported in {2:.2f}s'.format(stats['pairs'], self._minRatio, time.perf_counter() - start))
+
+    def chunkFiles(self):
+        """return a SpillSorter of the (chunk, file id) records of the files, chunked by the workers"""
+        sorter = doublonsV3.SpillSorter(self._spillRecords, self._spillDirectory)
+        pending = collections.deque()   #(file id, future) in the order of the files
+        with concurrent.futures.ProcessPoolExecutor(self._workers) as executor:
+            for path, info in self._crawler.scanFiles():
+                if info.st_size < self._minSize:
+                    continue
+                pending.append((self._paths.add(path, info), executor.submit(chunkFile, path, self._hashName, self._averageSize, self._blockSize,
+                                                                                   self._spillDirectory)))
+                while len(pending) > self._workers * doublonsV3.PENDING_TASKS:
+                    self.addChunks(sorter, *pending.popleft())
+            while pending:
+                self.addChunks(sorter, *pending.popleft())
+        return sorter
+
+    def addChunks(self, sorter, fileId, future):
+        """add the chunks of a file to sorter"""
+        try:
+            chunks, bytesRead = future.result()
+        except OSError:
+            self.log('an error occurred while reading {0}'.format(self._paths[fileId]))
+            self._stats['errors'] += 1
+            return
+
+        # the records are read by slices
+        width = doublonsV3.HASH_FUNCTIONS[self._hashName]().digest_size + 4
+        size = doublonsV3.SPILL_READ - doublonsV3.SPILL_READ % width
+        try:
+            with open(chunks, 'rb') as records:
+                while data := records.read(size):
+                    for offset in range(0, len(data), width):
+                        sorter.add(data[offset:offset+width], fileId)
+                    self._stats['chunks'] += len(data) // width
+        finally:
+            os.remove(chunks)
+        self._stats['files'] += 1
+        self._stats['bytes'] += bytesRead
+
+    def pairFiles(self, chunks):
+        """return a SpillSorter of the (pair of file ids, length) records of the chunks shared by several files"""
+        sorter = doublonsV3.SpillSorter(self._spillRecords, self._spillDirectory)
+        previous, count, fileIds = None, 0, []
+        for chunk, fileId in chunks:
+            if chunk != previous:
+                self.pairChunk(sorter, previous, count, fileIds)
+                previous, count, fileIds = chunk, 0, []
+            count += 1
+
+            # records of a chunk are sorted by file id, at most maxFiles + 1 files are kept
+            if (not fileIds or fileIds[-1] != fileId) and len(fileIds) <= self._maxFiles:
+                fileIds.append(fileId)
+        self.pairChunk(sorter, previous, count, fileIds)
+        return sorter
+
+    def pairChunk(self, sorter, chunk, count, fileIds):
+        """count a chunk found count times, add a record for each pair of distinct files sharing it"""
+        if chunk is None:
+            return
+        length = int.from_bytes(chunk[-4:], 'big')
+        self._stats['distinct'] += 1
+        self._stats['savings'] += length * (count - 1)
+
+        if len(fileIds) > self._maxFiles:
+            self._stats['common'] += 1
+            return
+        for index, first in enumerate(fileIds):
+            for second in fileIds[index+1:]:
+                sorter.add(first.to_bytes(4, 'big') + second.to_bytes(4, 'big'), length)
+
+    def rankPairs(self, pairs):
+        """return a SpillSorter of the pairs sharing at least minRatio of the smaller file, sorted by decreasing ratio"""
+        sorter = doublonsV3.SpillSorter(self._spillRecords, self._spillDirectory)
+        previous, shared = None, 0
+        for pair, length in pairs:
+            if pair != previous:
+                self.rankPair(sorter, previous, shared)
+                previous, shared = pair, 0
+            shared += length
+        self.rankPair(sorter, previous, shared)
+        return sorter
+
+    def rankPair(self, sorter, pair, shared):
+        if pair is None:
+            return
+        first, second = int.from_bytes(pair[:4], 'big'), int.from_bytes(pair[4:], 'big')
+        size = min(self._paths.info(first).st_size, self._paths.info(second).st_size)
+        ratio = min(shared / size, 1)       #chunks repeated in a file may be counted more than once
+        if ratio >= self._minRatio:
+            sorter.add((RATIO_SCALE - round(ratio * RATIO_SCALE)).to_bytes(4, 'big') + pair, shared)
+
+    def export(self, ranked):
+        """write the pairs: ratio, bytes shared, paths"""
+        with open(self._exportFile, 'w', encoding=self._encoding) as export:
+            for key, shared in ranked:
+                ratio = 1 - int.from_bytes(key[:4], 'big') / RATIO_SCALE
+                paths = [self._paths[int.from_bytes(key[4:8], 'big')], self._paths[int.from_bytes(key[8:], 'big')]]
+                export.write('{0:.3f}{1}'.format(ratio, self._splitSymbol))
+                export.write(doublonsV3.formatCopies(shared, paths, self._splitSymbol, self._prefixPath, self._separator))
+                self._stats['pairs'] += 1
+
+
+def getArgs():
+    """parse script arguments"""
+    parser = argparse.ArgumentParser(description='Find the pairs of files sharing chunks (near duplicates). '
+                                     'Chunks are cut by a pure Python rolling hash: about 5 MB/s per worker, '
+                                     'multi-GB images take minutes each')
+    parser.add_argument('exportFile', type=str, help="csv file filled with the pairs: ratio, bytes shared, paths")
+    parser.add_argument('rootDirectory', type=str, nargs='+', help="root directories")
+    parser.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function of the chunks")
+    parser.add_argument('-x', '--exclude', type=str, action='append', help="glob pattern of file or directory names/paths to skip (repeatable)")
+    parser.add_argument('-m', '--maxDepth', type=int, help="max depth of the subdirectories crawled")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="number of processes chunking files (default: number of CPUs)")
+    parser.add_argument('-a', '--averageSize', type=int, default=CHUNK_AVERAGE, help="average length of the chunks (power of 2)")
+    parser.add_argument('-z', '--minSize', type=int, default=SIMILAR_MIN_SIZE, help="min size of the files chunked")
+    parser.add_argument('-n', '--minRatio', type=float, default=SIMILAR_RATIO, help="min ratio of bytes shared (to the size of the smaller file)")
+    parser.add_argument('-g', '--maxFiles', type=int, default=SIMILAR_FILES, help="max number of files sharing a chunk to pair them")
+    parser.add_argument('-r', '--spillRecords', type=int, default=SIMILAR_RECORDS, help="max number of records kept in memory by each sort")
+    parser.add_argument('-T', '--spillDirectory', type=str, help="directory of the files spilled to disk")
+    parser.add_argument('-k', '--blockSize', type=int, default=doublonsV3.HASH_BLOCK_SIZE, help="size of the blocks read")
+    parser.add_argument('-p', '--prefixPath', type=str, default=doublonsV3.PREFIX_PATH, help="a prefix added to the paths in exportFile")
+    parser.add_argument('-e', '--encoding', type=str, help="encoding used to encode exportFile (utf8, latin1)")
+    parser.add_argument('-s', '--separator', type=str, help="specific pathname separator for data in exportFile")
+    parser.add_argument('-S', '--splitSymbol', type=str, default=doublonsV3.SPLIT_SYMBOL, help="specific symbol to separate data in exportFile")
+
+    args = parser.parse_args()
+    doublonsV3.checkRoots(args.rootDirectory)
+    if args.hashFunction not in doublonsV3.HASH_FUNCTIONS:
+        raise ValueError("invalid hash function supplied: {0}".format(args.hashFunction))
+    if args.averageSize < 64 or args.averageSize & (args.averageSize - 1):
+        raise ValueError("averageSize must be a power of 2 (at least 64)")
+    if args.workers < 1:
+        raise ValueError("workers must be a positive number")
+    if args.spillRecords < 2:
+        raise ValueError("spillRecords must be at least 2")
+    return args
+
+
+def run():
+    """run the script"""
+    args = getArgs()
+    SimilarFinder(**args.__dict__).run()
+
+
+if __name__ == '__main__':
+    run()
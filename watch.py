@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+########################################################
+# Watch daemon of the DuplicatesFinder (doublonsV3)    #
+########################################################
+
+# 1. a first scan stores the stat data of every file in a state file (sqlite), then hashes the files sharing their size
+# 2. changes are received from inotify (or found by a periodic rescan comparing stat data), files changed are updated
+# 3. only the groups of the sizes affected are computed again (unchanged files keep their hashes), then exportFile is rewritten
+
+__author__ = 'clsergent'
+__licence__ = 'EUPL1.2'
+
+import os
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import select
+import stat
+import struct
+import time
+
+import doublonsV3
+
+WATCH_DELAY = 2             # delay (seconds) during which events are gathered before the groups are updated
+RESCAN_DELAY = 3600         # delay (seconds) between two rescans (stat data of every file compared with the state)
+EVENT = struct.Struct('iIII')   # struct inotify_event: wd, mask, cookie, length of the name
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_WATCHED = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# name and path of a file, as read by FilesCrawler.isExcluded
+Entry = collections.namedtuple('Entry', ['name', 'path'])
+
+
+class Inotify(object):
+    """minimal inotify binding (linux), raise OSError if unavailable"""
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is unavailable")
+        self._directories = dict()      #dict of watch descriptor:directory
+
+    def add(self, directory):
+        """watch the changes of the files of a directory"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_WATCHED)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "{0} can't be watched".format(directory))
+        self._directories[wd] = directory
+
+    def read(self, timeout):
+        """return the events [(path, mask)] received within timeout (seconds)"""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+
+        data = os.read(self._fd, 1048576)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+            offset += EVENT.size + length
+
+            if mask & IN_IGNORED:       #the directory was deleted or moved
+                self._directories.pop(wd, None)
+            elif wd in self._directories or mask & IN_Q_OVERFLOW:
+                events.append((os.path.join(self._directories.get(wd, ''), name), mask))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WatchState(doublonsV3.HashCache):
+    """stat data and hashes of the files watched, groups of duplicates of each size"""
+    TABLES = ('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)',
+              'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, dev INTEGER, ino INTEGER, mtime INTEGER, '
+              'nlink INTEGER, partial BLOB, full BLOB, scan INTEGER)',
+              'CREATE INDEX IF NOT EXISTS filesSize ON files (size)',
+              'CREATE TABLE IF NOT EXISTS groups (size INTEGER, digest BLOB, paths TEXT)',    #paths are separated by \0
+              'CREATE INDEX IF NOT EXISTS groupsSize ON groups (size)')
+
+    def checkMeta(self, **values):
+        """store the settings of the hashes, the hashes and the groups being cleared if they changed (return True)"""
+        connection = self.connection
+        stored = dict(connection.execute('SELECT key, value FROM meta'))
+        if stored == values:
+            return False
+        with connection:
+            connection.execute('UPDATE files SET partial = NULL, full = NULL')
+            connection.execute('DELETE FROM groups')
+            connection.execute('DELETE FROM meta')
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', values.items())
+        return bool(stored)
+
+
+class DuplicatesWatcher(object):
+    """keep the groups of duplicates of the root directories up to date"""
+    def __init__(self, state, exportFile, rootDirectory, hashFunction='md5', fullHashFunction=None, hashBytes=doublonsV3.HASH_BYTES,
+                 exclude=None, maxDepth=None, blockSize=doublonsV3.HASH_BLOCK_SIZE, splitSymbol=doublonsV3.SPLIT_SYMBOL,
+                 prefixPath='', encoding=None, separator=None, delay=WATCH_DELAY, rescanDelay=RESCAN_DELAY, **kwds):
+        self._state = WatchState(state, hashFunction)
+        self._exportFile = exportFile
+        self._crawler = doublonsV3.FilesCrawler(rootDirectory, hashFunction, hashBytes, exclude=exclude, maxDepth=maxDepth)
+        self._rootDirectories = [os.path.join(directory, '') for directory in rootDirectory]
+        self._hashName = hashFunction
+        self._fullHashName = fullHashFunction if fullHashFunction else hashFunction
+        self._hashBytes = hashBytes
+        self._maxDepth = maxDepth
+        self._blockSize = blockSize
+        self._splitSymbol = splitSymbol
+        self._prefixPath = prefixPath
+        self._encoding = encoding
+        self._separator = separator
+        self._delay = delay
+        self._rescanDelay = rescanDelay
+        self._inotify = None
+        self._affected = set()      #sizes whose groups must be computed again
+        self._generation = 0        #number of the current rescan
+
+    def log(self, *logs):
+        print('watch:', *logs)
+
+    def run(self):
+        """scan, then update the groups until interrupted"""
+        try:
+            self._inotify = Inotify()
+        except OSError as error:
+            self.log('{0}, changes are found by a rescan every {1}s'.format(error, self._rescanDelay))
+
+        # hashes computed with other settings are computed again
+        if self._state.checkMeta(hashFunction=self._hashName, fullHashFunction=self._fullHashName, hashBytes=self._hashBytes):
+            self.log('hash settings changed, every group is computed again')
+            self._affected.update(size for size, in self._state.connection.execute('SELECT DISTINCT size FROM files'))
+
+        self.rescan()
+        rescanned = time.monotonic()
+        try:
+            while True:
+                events = self.wait(max(0, rescanned + self._rescanDelay - time.monotonic()))
+                if any(mask & IN_Q_OVERFLOW for path, mask in events) or time.monotonic() - rescanned >= self._rescanDelay:
+                    self.rescan()
+                    rescanned = time.monotonic()
+                elif events:
+                    self.handle(events)
+                    self.update()
+        except KeyboardInterrupt:
+            self.log('stopped')
+        finally:
+            if self._inotify:
+                self._inotify.close()
+
+    def wait(self, timeout):
+        """return the events received within timeout, and the ones following them within delay"""
+        if not self._inotify:
+            time.sleep(timeout)
+            return []
+
+        events = self._inotify.read(timeout)
+        if events:
+            end = time.monotonic() + self._delay
+            while time.monotonic() < end:
+                events.extend(self._inotify.read(max(0, end - time.monotonic())))
+        return events
+
+    def rescan(self):
+        """compare the stat data of every file with the state, then update the groups"""
+        start = time.perf_counter()
+        self._generation = (self._state.connection.execute('SELECT MAX(scan) FROM files').fetchone()[0] or 0) + 1
+        with self._state.connection:
+            for rootDirectory in self._rootDirectories:
+                self.scanDirectory(rootDirectory.rstrip(os.sep) or os.sep)
+
+            # files not found anymore
+            for size, in self._state.connection.execute('SELECT DISTINCT size FROM files WHERE scan < ?', (self._generation,)):
+                self._affected.add(size)
+            self._state.connection.execute('DELETE FROM files WHERE scan < ?', (self._generation,))
+
+        self.log('rescan: {0} sizes affected in {1:.2f}s'.format(len(self._affected), time.perf_counter() - start))
+        self.update()
+
+    def scanDirectory(self, directory):
+        """update the files of a directory and its subdirectories, watch each directory"""
+        directories = [(directory, self.depth(directory))]
+        while directories:
+            directory, depth = directories.pop()
+            if self._inotify:
+                try:
+                    self._inotify.add(directory)
+                except OSError as error:
+                    self.log('{0}, changes are found by a rescan every {1}s'.format(error, self._rescanDelay))
+                    self._inotify.close()
+                    self._inotify = None
+
+            files, subDirectories = self._crawler.listDirectory(directory, depth)
+            for path, info in files:
+                self.updateFile(path, info)
+            directories.extend(subDirectories)
+
+    def depth(self, path):
+        """return the depth of a directory below its root directory"""
+        for rootDirectory in self._rootDirectories:
+            if os.path.join(path, '').startswith(rootDirectory):
+                return os.path.relpath(path, rootDirectory).count(os.sep) + (path != rootDirectory.rstrip(os.sep))
+        return 0
+
+    def isListed(self, path, isDirectory):
+        """return True if path is listed by a scan (not excluded, not too deep), as checked by FilesCrawler.listDirectory"""
+        directory, name = os.path.split(path)
+        if self._crawler.isExcluded(Entry(name, path)):
+            return False
+        if self._maxDepth is None:
+            return True
+        return self.depth(directory) < self._maxDepth if isDirectory else self.depth(directory) <= self._maxDepth
+
+    def handle(self, events):
+        """update the files and directories changed"""
+        with self._state.connection:
+            for path, mask in events:
+                if mask & IN_ISDIR:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.removeFiles(path)
+                    if mask & (IN_CREATE | IN_MOVED_TO) and self.isListed(path, True):
+                        self.scanDirectory(path)
+                    continue
+
+                info = None
+                if self.isListed(path, False):
+                    try:
+                        status = os.lstat(path)
+                    except OSError:
+                        status = None
+                    if status and stat.S_ISREG(status.st_mode) and status.st_size:
+                        info = doublonsV3.FileInfo(status.st_size, status.st_dev, status.st_ino, status.st_mtime_ns, status.st_nlink)
+
+                if info:
+                    self.updateFile(path, info)
+                else:
+                    self.removeFiles(path)
+
+    def updateFile(self, path, info):
+        """store the stat data of a file, its hashes being kept unless it was modified"""
+        connection = self._state.connection
+        row = connection.execute('SELECT size, dev, ino, mtime, nlink FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[:4] == (info.st_size, info.st_dev, info.st_ino, info.st_mtime_ns):
+            connection.execute('UPDATE files SET nlink = ?, scan = ? WHERE path = ?', (info.st_nlink, self._generation, path))
+            return
+
+        connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)',
+                           (path, info.st_size, info.st_dev, info.st_ino, info.st_mtime_ns, info.st_nlink, self._generation))
+        self._affected.add(info.st_size)
+        if row:
+            self._affected.add(row[0])
+
+    def removeFiles(self, path):
+        """remove a file, or the files of a directory"""
+        connection = self._state.connection
+        prefix = os.path.join(path, '')
+        where = 'path = ? OR substr(path, 1, ?) = ?'
+        for size, in connection.execute('SELECT DISTINCT size FROM files WHERE ' + where, (path, len(prefix), prefix)):
+            self._affected.add(size)
+        connection.execute('DELETE FROM files WHERE ' + where, (path, len(prefix), prefix))
+
+    def update(self):
+        """compute the groups of the sizes affected, then rewrite exportFile"""
+        if not self._affected and os.path.exists(self._exportFile):
+            return
+        start = time.perf_counter()
+        with self._state.connection:
+            for size in sorted(self._affected):
+                self.refresh(size)
+        self.log('{0} sizes updated in {1:.2f}s'.format(len(self._affected), time.perf_counter() - start))
+        self._affected = set()
+        self.export()
+
+    def refresh(self, size):
+        """compute the groups of duplicates of a size, hashing the files which have no hash yet"""
+        connection = self._state.connection
+        connection.execute('DELETE FROM groups WHERE size = ?', (size,))
+
+        # paths sharing an inode are hard links (the first path is kept)
+        files, inodes = [], set()
+        for path, dev, ino, partial, full in connection.execute('SELECT path, dev, ino, partial, full FROM files WHERE size = ? ORDER BY path', (size,)):
+            if (dev, ino) not in inodes:
+                inodes.add((dev, ino))
+                files.append([path, partial, full])
+        if len(files) < 2:
+            return
+
+        # the first hash covers the whole file of small sizes
+        complete = self._hashBytes < 0 or size <= self._hashBytes
+        for group in self.split(files, 1, lambda path: doublonsV3.partialHash(path, self._hashName, self._hashBytes)[0], 'partial'):
+            groups = [group] if complete else self.split(group, 2, lambda path: doublonsV3.hashFile(path, self._fullHashName, self._blockSize)[0], 'full')
+            for group in groups:
+                connection.execute('INSERT INTO groups VALUES (?, ?, ?)', (size, group[0][1 if complete else 2], '\0'.join(file[0] for file in group)))
+
+    def split(self, files, index, hash, column):
+        """return the groups of files ([path, partial, full]) sharing the hash at index (computed and stored if missing)"""
+        for file in files:
+            if file[index] is None:
+                try:
+                    file[index] = hash(file[0])
+                except OSError:
+                    self.log('an error occurred while reading {0}'.format(file[0]))
+                    continue
+                self._state.connection.execute('UPDATE files SET {0} = ? WHERE path = ?'.format(column), (file[index], file[0]))
+
+        groups = collections.defaultdict(list)
+        for file in files:
+            if file[index] is not None:
+                groups[file[index]].append(file)
+        return [group for group in groups.values() if len(group) >= 2]
+
+    def export(self):
+        """rewrite exportFile from the groups stored"""
+        temporary = self._exportFile + '.tmp'
+        groups = 0
+        with open(temporary, 'w', encoding=self._encoding) as export:
+            for size, paths in self._state.connection.execute('SELECT size, paths FROM groups ORDER BY size DESC, digest'):
+                export.write(doublonsV3.formatCopies(size, paths.split('\0'), self._splitSymbol, self._prefixPath, self._separator))
+                groups += 1
+        os.replace(temporary, self._exportFile)
+        self.log('{0} groups of duplicates exported'.format(groups))
+
+
+def getArgs():
+    """parse script arguments"""
+    parser = argparse.ArgumentParser(description='Keep the duplicates of root directories up to date')
+    parser.add_argument('state', type=str, help="state file (sqlite) kept between runs")
+    parser.add_argument('exportFile', type=str, help="csv file filled with duplicates info (rewritten on changes)")
+    parser.add_argument('rootDirectory', type=str, nargs='+', help="root directories to watch")
+    parser.add_argument('-f', '--hashFunction', type=str, default='md5', help="hash function used for the first hash")
+    parser.add_argument('-F', '--fullHashFunction', type=str, help="hash function used for the complete hash (default: hashFunction)")
+    parser.add_argument('-b', '--hashBytes', type=int, default=doublonsV3.HASH_BYTES, help="number of bytes used for the first hash")
+    parser.add_argument('-k', '--blockSize', type=int, default=doublonsV3.HASH_BLOCK_SIZE, help="size of the blocks read to compute complete hashes")
+    parser.add_argument('-x', '--exclude', type=str, action='append', help="glob pattern of file or directory names/paths to skip (repeatable)")
+    parser.add_argument('-m', '--maxDepth', type=int, help="max depth of the subdirectories watched")
+    parser.add_argument('-p', '--prefixPath', type=str, default=doublonsV3.PREFIX_PATH, help="a prefix added to the paths in exportFile")
+    parser.add_argument('-e', '--encoding', type=str, help="encoding used to encode exportFile (utf8, latin1)")
+    parser.add_argument('-s', '--separator', type=str, help="specific pathname separator for data in exportFile")
+    parser.add_argument('-S', '--splitSymbol', type=str, default=doublonsV3.SPLIT_SYMBOL, help="specific symbol to separate data in exportFile")
+    parser.add_argument('-W', '--delay', type=float, default=WATCH_DELAY, help="delay (seconds) during which events are gathered")
+    parser.add_argument('-R', '--rescanDelay', type=float, default=RESCAN_DELAY, help="delay (seconds) between two rescans of every file")
+
+    args = parser.parse_args()
+    doublonsV3.checkRoots(args.rootDirectory)
+    args.rootDirectory = [os.path.realpath(directory) for directory in args.rootDirectory]
+    for hashFunction in (args.hashFunction, args.fullHashFunction):
+        if hashFunction and hashFunction not in doublonsV3.HASH_FUNCTIONS:
+            raise ValueError("invalid hash function supplied: {0}".format(hashFunction))
+    return args
+
+
+def run():
+    """run the daemon"""
+    args = getArgs()
+    DuplicatesWatcher(**args.__dict__).run()
+
+
+if __name__ == '__main__':
+    run()